@@ -1,13 +1,38 @@
 from flask import Flask
 from werkzeug.routing import IntegerConverter as BaseIntegerConverter
 
-app = Flask(__name__)
+import config
 
 
 class IntegerConverter(BaseIntegerConverter):
     regex = r'-?\d+'
 
 
-app.url_map.converters['int'] = IntegerConverter
+def create_app(db=None, replicas=None, create_schema=None, **engine_options):
+    """Creates the web app.
 
-from app import views
+    `db`, `replicas` and `engine_options` override config.DB, config.DB_REPLICAS and
+    the create_engine() options, the database is first connected on the first query. Missing tables are created
+    only with `create_schema` or config.CREATE_SCHEMA, otherwise run `flask create-schema`.
+    """
+    from app import views, commands, metrics, lazyloads
+    from app.types import Session, init_engine, create_schema as create_tables
+
+    app = Flask(__name__)
+    app.url_map.converters['int'] = IntegerConverter
+    app.secret_key = config.APP_SECRET_KEY
+    # Страницы, где сессия не менялась, не продлевают cookie и поэтому кэшируются
+    app.config['SESSION_REFRESH_EACH_REQUEST'] = False
+    if db is not None or replicas is not None or engine_options:
+        init_engine(db, replicas, **engine_options)
+    if create_schema is None:
+        create_schema = getattr(config, 'CREATE_SCHEMA', False)
+    if create_schema:
+        create_tables()
+    # Соединение возвращается в пул после каждого запроса, а не остаётся за потоком
+    app.teardown_appcontext(lambda exc: Session.remove())
+    metrics.init_app(app)
+    lazyloads.init_app(app)
+    app.register_blueprint(views.blueprint)
+    commands.init_app(app)
+    return app
@@ -0,0 +1,239 @@
+import json
+import math
+import random
+import tracemalloc
+from base64 import b64encode
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from sqlalchemy import func
+
+from config import AUTH_LOGIN, AUTH_PASS, CASTLE
+from app.constants import STUFF, EQUIP_PARTS
+from app.lazyloads import query_budget
+from app.rollups import rebuild_latest_snapshots, rebuild_battle_rollups, rebuild_build_rollups, backfill_equip_changes
+from app.types import (AdminType, Admin, Group, Squad, SquadMember, User, Character, Equip, Stock, Report, BuildReport,
+                       BATTLE_HOURS)
+from app.views import RESPONSE_CACHE
+
+INSERT_CHUNK = 5000
+MODIFIERS = ['', '', '⚡+1 ', '⚡+2 ', '⚡+3 ', '⚡+5 ']
+RESOURCES = ['Нитки', 'Кожа', 'Железная руда', 'Уголь', 'Древесина', 'Порошок', 'Плотная ткань', 'Растворитель',
+             'Мифриловая руда', 'Металлическое волокно', 'Обработанная кожа', 'Полотно']
+BUILDINGS = ['Стена', 'Ворота', 'Башня', 'Казарма']
+PROFS = ['⚔Рыцарь', '🛡Защитник', '⚒Кузнец', '📦Добытчик', '🏹Лучник', '⚗️Алхимик']
+
+
+class BenchError(Exception):
+    pass
+
+
+class BulkWriter(object):
+    """Buffers rows per table and inserts them with executemany, bypassing the ORM listeners."""
+
+    def __init__(self, session):
+        self.session = session
+        self.rows = {}
+        self.counts = {}
+
+    def add(self, model, **row):
+        table = model.__table__
+        self.rows.setdefault(table, []).append(row)
+        if len(self.rows[table]) >= INSERT_CHUNK:
+            self.flush(table)
+
+    def flush(self, table=None):
+        for table in [table] if table is not None else list(self.rows):
+            rows = self.rows.pop(table, [])
+            if rows:
+                self.session.execute(table.insert(), rows)
+                self.counts[table.name] = self.counts.get(table.name, 0) + len(rows)
+        self.session.commit()
+
+
+def equip_text(slots):
+    return '\n'.join(modifier + item for modifier, item in slots if item)
+
+
+def random_slot(rng, part):
+    if rng.random() < 0.15:
+        return '', None
+    return rng.choice(MODIFIERS), rng.choice(STUFF[part])[0]
+
+
+def generate_dataset(session, users=2000, squads=40, days=90, seed=1, now=None):
+    """Fills an empty database with a synthetic castle, returns {table: rows}.
+
+    Every player gets a profile snapshot about once a day, equip every three days,
+    stock every two days, a report for most battles and some construction reports.
+    The same seed gives the same data relative to `now`.
+    """
+    if session.query(func.count(User.id)).scalar():
+        raise BenchError('the database already has users, generate into an empty one')
+    rng = random.Random(seed)
+    now = (now or datetime.now()).replace(microsecond=0)
+    start = now - timedelta(days=days)
+    castle = CASTLE or '🇰🇮'
+    writer = BulkWriter(session)
+    squad_ids = [-1001000000 - number for number in range(squads)]
+    for number, squad_id in enumerate(squad_ids):
+        writer.add(Group, id=squad_id, title='Squad {}'.format(number), bot_in_group=True)
+    writer.flush()
+    for number, squad_id in enumerate(squad_ids):
+        writer.add(Squad, chat_id=squad_id, squad_name='Squad {}'.format(number), invite_link='')
+    for user_id in range(1, users + 1):
+        writer.add(User, id=user_id, username='player{}'.format(user_id), first_name='Player', date_added=start)
+    writer.flush()
+    writer.add(Admin, user_id=1, admin_type=AdminType.SUPER.value, admin_group=0)
+    for user_id in range(1, users + 1):
+        if rng.random() < 0.8:
+            writer.add(SquadMember, squad_id=rng.choice(squad_ids), user_id=user_id, approved=True)
+        level, attack, defence, exp, gold = rng.randint(5, 30), rng.randint(10, 60), rng.randint(10, 60), 0, 0
+        name, prof = 'Player{}'.format(user_id), rng.choice(PROFS)
+        slots = [random_slot(rng, part) for part in EQUIP_PARTS]
+        stock = {resource: rng.randint(0, 50) for resource in rng.sample(RESOURCES, 6)}
+        joined = start + timedelta(days=rng.uniform(0, days / 3.0))
+        for day in range((now - joined).days + 1):
+            date = joined + timedelta(days=day, minutes=rng.randint(0, 600))
+            if date > now:
+                break
+            exp += rng.randint(50, 400)
+            gold = max(gold + rng.randint(-20, 40), 0)
+            if rng.random() < 0.1:
+                level += 1
+                attack += rng.randint(0, 3)
+                defence += rng.randint(0, 3)
+            writer.add(Character, user_id=user_id, date=date, name=name, prof=prof, level=level, attack=attack,
+                       defence=defence, exp=exp, needExp=exp + 1000, castle=castle, gold=gold, donateGold=0)
+            if day % 3 == 0:
+                if day and rng.random() < 0.5:
+                    part = rng.randrange(len(EQUIP_PARTS))
+                    slots[part] = random_slot(rng, EQUIP_PARTS[part])
+                writer.add(Equip, user_id=user_id, date=date + timedelta(seconds=1), equip=equip_text(slots))
+            if day % 2 == 0:
+                for resource in stock:
+                    stock[resource] = max(stock[resource] + rng.randint(-5, 8), 0)
+                writer.add(Stock, user_id=user_id, date=date + timedelta(seconds=2), stock_type=0,
+                           stock='📦Склад:\n' + '\n'.join('{} ({})'.format(resource, count)
+                                                         for resource, count in sorted(stock.items()) if count))
+            for hour in BATTLE_HOURS:
+                battle = (joined + timedelta(days=day)).replace(hour=hour, minute=0, second=0)
+                if joined < battle <= now and rng.random() < 0.6:
+                    writer.add(Report, user_id=user_id, date=battle + timedelta(minutes=rng.randint(1, 120)),
+                               name=name, level=level, attack=attack, defence=defence, castle=castle,
+                               earned_exp=rng.randint(5, 60), earned_gold=rng.randint(0, 10),
+                               earned_stock=rng.randint(0, 30))
+            if rng.random() < 0.3:
+                progress = int(100 * (date - start).total_seconds() / (now - start).total_seconds())
+                writer.add(BuildReport, user_id=user_id, date=date + timedelta(seconds=3),
+                           building=rng.choice(BUILDINGS), progress_percent=min(progress, 100), report_type=0)
+    writer.flush()
+    counts = dict(writer.counts)
+    counts.update(rebuild_latest_snapshots(session))
+    counts['battle_rollups'] = rebuild_battle_rollups(session)
+    counts['build_rollups'] = rebuild_build_rollups(session)
+    counts['equip_changes'] = sum(rows for last_user, rows in backfill_equip_changes(session))
+    return counts
+
+
+def bench_routes(session):
+    """Paths to measure, with ids taken from the database."""
+    squad_id = session.query(SquadMember.squad_id).group_by(SquadMember.squad_id) \
+        .order_by(func.count(SquadMember.user_id).desc()).limit(1).scalar()
+    user_id = session.query(Character.user_id).group_by(Character.user_id) \
+        .order_by(func.count(Character.date).desc()).limit(1).scalar()
+    paths = ['/users', '/users?all=1', '/squads', '/top', '/reports', '/build']
+    if squad_id is not None:
+        paths += ['/member-equip/{}'.format(squad_id), '/equip-changes/{}'.format(squad_id),
+                  '/reports?squad={}'.format(squad_id), '/squad_craft?squad={}'.format(squad_id)]
+    if user_id is not None:
+        paths += ['/player/{}'.format(user_id), '/player/{}/history.json'.format(user_id)]
+    return paths
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(int(math.ceil(q * len(values))) - 1, 0)]
+
+
+def bench_client(app, user_id=1):
+    client = app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = user_id
+    return client
+
+
+def auth_headers():
+    credentials = '{}:{}'.format(AUTH_LOGIN, AUTH_PASS).encode('utf-8')
+    return {'Authorization': 'Basic ' + b64encode(credentials).decode('ascii')}
+
+
+def measure_route(client, path, repeat=20, cold=True):
+    """{p50_ms, p99_ms, queries, peak_kb} of `repeat` requests of `path` after one warm-up request.
+
+    With `cold` the response cache is emptied before every request, so the views do their full work.
+    """
+    headers = auth_headers()
+
+    def request():
+        if cold:
+            RESPONSE_CACHE.backend.clear()
+        response = client.get(path, headers=headers)
+        response.get_data()
+        if response.status_code != 200:
+            raise BenchError('{}: status {}'.format(path, response.status_code))
+
+    request()
+    times = []
+    queries = 0
+    for _ in range(repeat):
+        with query_budget() as audit:
+            started = perf_counter()
+            request()
+            times.append(perf_counter() - started)
+        queries = max(queries, audit.queries)
+    tracemalloc.start()
+    try:
+        request()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'p50_ms': round(percentile(times, 0.5) * 1000, 2), 'p99_ms': round(percentile(times, 0.99) * 1000, 2),
+            'queries': queries, 'peak_kb': peak // 1024}
+
+
+def run_bench(app, session, paths=None, repeat=20, cold=True, user_id=1):
+    """Yields (path, measurements) for every route of `app`."""
+    client = bench_client(app, user_id)
+    for path in paths or bench_routes(session):
+        yield path, measure_route(client, path, repeat, cold)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Regressions of `results` against `baseline` as readable lines.
+
+    Times and memory may grow by `tolerance`, query counts may not grow at all.
+    """
+    regressions = []
+    for path, current in sorted(results.items()):
+        previous = baseline.get(path)
+        if previous is None:
+            continue
+        for metric in ['p50_ms', 'p99_ms', 'peak_kb']:
+            if current[metric] > previous[metric] * (1 + tolerance):
+                growth = float(current[metric]) / previous[metric] - 1 if previous[metric] else 1
+                regressions.append('{} {}: {} > {} (+{:.0%})'.format(path, metric, current[metric], previous[metric],
+                                                                    growth))
+        if current['queries'] > previous['queries']:
+            regressions.append('{} queries: {} > {}'.format(path, current['queries'], previous['queries']))
+    return regressions
+
+
+def load_results(path):
+    with open(path) as results:
+        return json.load(results)
+
+
+def save_results(path, results):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class LRUCache(object):
+    """Bounded thread-safe LRU cache with hit/miss counters."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory, *args):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = factory(*args)
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ParseCache(LRUCache):
+    """Parsed text of rows that never change after they are written, kept by the primary key of the row.
+
+    Parsed values are shared between requests and must not be modified.
+    """
+
+    def __init__(self, parser, maxsize=1000):
+        super(ParseCache, self).__init__(maxsize)
+        self.parser = parser
+
+    def parse(self, key, text):
+        """Parsed `text` of the row with primary key `key`; rows without a key are parsed every time."""
+        if key is None:
+            return self.parser(text)
+        return self.get_or_create(key, self.parser, text)
+
+
+class MemoryCache(LRUCache):
+    """In-process cache backend with the get/set/delete interface of the werkzeug caches."""
+
+    def __init__(self, maxsize=1000, default_timeout=300):
+        super(MemoryCache, self).__init__(maxsize)
+        self.default_timeout = default_timeout
+
+    def get(self, key, default=None):
+        entry = super(MemoryCache, self).get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires and expires < time():
+            self.delete(key)
+            return default
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        super(MemoryCache, self).set(key, (time() + timeout if timeout else 0, value))
+        return True
+
+
+class ResponseCache(object):
+    """Rendered pages stored together with the watermark they were rendered at.
+
+    An entry is dropped by its timeout or as soon as the watermark of the
+    data behind it changes. `backend` is any object with get/set(timeout)
+    methods, e.g. a werkzeug RedisCache shared by several workers.
+    """
+
+    def __init__(self, backend=None, timeout=60, prefix='view:'):
+        self.backend = backend if backend is not None else MemoryCache(default_timeout=timeout)
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def get(self, key, watermark=None):
+        entry = self.backend.get(self.prefix + key)
+        if entry is None or entry[0] != watermark:
+            return None
+        return entry[1]
+
+    def set(self, key, value, watermark=None):
+        self.backend.set(self.prefix + key, (watermark, value), timeout=self.timeout)
@@ -0,0 +1,69 @@
+from datetime import datetime
+
+
+def lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets downsampling of (x, y) points sorted by x.
+
+    Keeps the first and the last point and from every bucket in between the point
+    forming the largest triangle with the previous kept point and the average of
+    the next bucket, so peaks and drops survive.
+    """
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+    sampled = [points[0]]
+    every = (len(points) - 2) / float(threshold - 2)
+    previous = points[0]
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        following = points[end:next_end] or points[-1:]
+        avg_x = sum(x for x, y in following) / float(len(following))
+        avg_y = sum(y for x, y in following) / float(len(following))
+        best, best_area = None, -1
+        for point in points[start:end]:
+            area = abs((previous[0] - avg_x) * (point[1] - previous[1]) -
+                       (previous[0] - point[0]) * (avg_y - previous[1]))
+            if area > best_area:
+                best, best_area = point, area
+        sampled.append(best)
+        previous = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def chart_points(values, width=600, height=150, padding=5, xs=None):
+    """Coordinates of an SVG polyline drawing `values` from left to right.
+
+    Without `xs` the values are spaced evenly, otherwise placed by their x.
+    """
+    if xs is None:
+        xs = range(len(values))
+    points = [(x, value) for x, value in zip(xs, values) if value is not None]
+    if not points:
+        return ''
+    low, high = min(value for x, value in points), max(value for x, value in points)
+    first, last = points[0][0], points[-1][0]
+    span = (high - low) or 1
+    step = (width - 2 * padding) / float((last - first) or 1)
+    return ' '.join('{:.1f},{:.1f}'.format(padding + (x - first) * step,
+                                           height - padding - (value - low) * (height - 2 * padding) / float(span))
+                    for x, value in points)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def timestamp(date):
+    return int((date - EPOCH).total_seconds())
+
+
+def timelines(rows, metrics, threshold):
+    """{metric: [(timestamp, value)]} of (date, value, ...) rows, each downsampled to `threshold` points."""
+    series = {metric: [] for metric in metrics}
+    for row in rows:
+        x = timestamp(row[0])
+        for metric, value in zip(metrics, row[1:]):
+            if value is not None:
+                series[metric].append((x, value))
+    return {metric: lttb(points, threshold) for metric, points in series.items()}
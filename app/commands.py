@@ -0,0 +1,184 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import inspect
+
+from app.bench import BenchError, bench_routes, generate_dataset, run_bench, compare, load_results, save_results
+from app.explain import check_queries
+from app.loadtest import LoadTestError, scaling_test
+from app.retention import HISTORY_MODELS, RETENTION, Archive, compact_table, table_size
+from app.rollups import (BACKFILL_USERS, rebuild_latest_snapshots, rebuild_battle_rollups, rebuild_build_rollups,
+                         backfill_equip_changes)
+from app.types import Base, Session, create_schema
+
+# Команды добавляются в `flask` через init_app()
+cli = AppGroup('castlestats')
+
+
+@cli.command('rebuild-latest')
+def rebuild_latest():
+    """Refills characters_latest and equip_latest from the full history."""
+    for name, rows in rebuild_latest_snapshots(Session()):
+        click.echo('{}: {} rows'.format(name, rows))
+
+
+@cli.command('create-indexes')
+def create_indexes():
+    """Creates indexes declared in the models that are missing in the database."""
+    session = Session()
+    bind = session.get_bind()
+    inspector = inspect(bind)
+    tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind)
+                click.echo('created {}'.format(index.name))
+
+
+@cli.command('create-schema')
+@click.pass_context
+def create_schema_command(ctx):
+    """Creates missing tables, then indexes missing in existing tables."""
+    create_schema()
+    ctx.invoke(create_indexes)
+
+
+@cli.command('explain-check')
+@click.option('--squad-id', default=0, help='Squad to build the squad queries for.')
+@click.option('--user-id', default=0, help='Player to build the player queries for.')
+@click.option('--building', default='', help='Building to build the build queries for.')
+@click.option('--verbose', is_flag=True, help='Print the plan of every query.')
+def explain_check(squad_id, user_id, building, verbose):
+    """Runs EXPLAIN on the view queries and fails on full scans of large tables."""
+    failed = False
+    for name, plan, scans in check_queries(Session(), squad_id, user_id, building):
+        if verbose:
+            for row in plan:
+                click.echo('  {}: {}'.format(name, tuple(row)))
+        if scans:
+            failed = True
+            click.echo('{}: full scan of {}'.format(name, ', '.join(scans)), err=True)
+        else:
+            click.echo('{}: ok'.format(name))
+    if failed:
+        raise SystemExit(1)
+
+
+@cli.command('rebuild-rollups')
+def rebuild_rollups():
+    """Recomputes the battle report and construction rollups from the raw reports."""
+    click.echo('battle_rollups: {} rows'.format(rebuild_battle_rollups(Session())))
+    click.echo('build_buckets, build_contributions: {} rows'.format(rebuild_build_rollups(Session())))
+
+
+@cli.command('backfill-equip-changes')
+@click.option('--after-user', type=int, default=None, help='Continue after this user id.')
+@click.option('--batch-users', type=int, default=BACKFILL_USERS, help='Users per transaction.')
+def backfill_equip_changes_command(after_user, batch_users):
+    """Fills equip_changes from the existing equip history."""
+    total = 0
+    for last_user, rows in backfill_equip_changes(Session(), after_user, batch_users):
+        total += rows
+        click.echo('up to user {}: {} rows'.format(last_user, rows))
+    click.echo('equip_changes: {} rows'.format(total))
+
+
+@cli.command('compact-history')
+@click.option('--table', 'tables', multiple=True, type=click.Choice(sorted(HISTORY_MODELS)),
+              help='Table to compact, all tables with RETENTION rules by default.')
+@click.option('--after-user', type=int, default=None, help='Continue after this user id.')
+@click.option('--dry-run', is_flag=True, help='Only count the rows that would be dropped.')
+@click.option('--optimize', is_flag=True, help='Run OPTIMIZE TABLE afterwards to give the space back (MySQL).')
+def compact_history(tables, after_user, dry_run, optimize):
+    """Moves snapshots that RETENTION does not keep into gzipped archives."""
+    session = Session()
+    for name in tables or sorted(RETENTION):
+        if name not in RETENTION:
+            click.echo('{}: no retention rules'.format(name))
+            continue
+        size = table_size(session, name)
+        archive = None if dry_run else Archive(name)
+        dropped = 0
+        for last_user, rows in compact_table(session, name, RETENTION[name], archive, after_user):
+            dropped += rows
+            click.echo('{}: up to user {}: {} rows'.format(name, last_user, rows))
+        if optimize and archive is not None and session.get_bind().dialect.name == 'mysql':
+            session.execute('OPTIMIZE TABLE {}'.format(name))
+        if archive is None:
+            click.echo('{}: {} rows to drop'.format(name, dropped))
+            continue
+        line = '{}: {} rows dropped, {} archive bytes in {}'.format(name, dropped, archive.size, archive.path)
+        reclaimed = table_size(session, name)
+        if size is not None and reclaimed is not None:
+            line += ', {} table bytes reclaimed'.format(size - reclaimed)
+        click.echo(line)
+
+
+@cli.command('bench-generate')
+@click.option('--users', default=2000, help='Number of players.')
+@click.option('--squads', default=40, help='Number of squads.')
+@click.option('--days', default=90, help='Days of history per player.')
+@click.option('--seed', default=1, help='Random seed, the same seed gives the same data.')
+def bench_generate(users, squads, days, seed):
+    """Fills an empty database with a synthetic castle for bench-run."""
+    try:
+        counts = generate_dataset(Session(), users, squads, days, seed)
+    except BenchError as e:
+        raise click.ClickException(str(e))
+    for table, rows in sorted(counts.items()):
+        click.echo('{}: {} rows'.format(table, rows))
+
+
+@cli.command('bench-run')
+@click.option('--path', 'paths', multiple=True, help='Route to measure, all benchmarked routes by default.')
+@click.option('--repeat', default=20, help='Requests per route.')
+@click.option('--warm', is_flag=True, help='Keep the response cache between requests.')
+@click.option('--save', type=click.Path(), help='Write the results to this JSON file.')
+@click.option('--baseline', type=click.Path(exists=True), help='Fail if slower than the results in this file.')
+@click.option('--tolerance', default=0.2, help='Allowed relative growth of times and memory.')
+def bench_run(paths, repeat, warm, save, baseline, tolerance):
+    """Measures latency, SQL queries and peak memory of the routes through the test client."""
+    results = {}
+    click.echo('{:<40} {:>9} {:>9} {:>8} {:>9}'.format('route', 'p50 ms', 'p99 ms', 'queries', 'peak KB'))
+    try:
+        for path, result in run_bench(current_app._get_current_object(), Session(), paths, repeat, cold=not warm):
+            results[path] = result
+            click.echo('{:<40} {p50_ms:>9} {p99_ms:>9} {queries:>8} {peak_kb:>9}'.format(path, **result))
+    except BenchError as e:
+        raise click.ClickException(str(e))
+    if save:
+        save_results(save, results)
+    if baseline:
+        regressions = compare(results, load_results(baseline), tolerance)
+        for line in regressions:
+            click.echo('regression: {}'.format(line), err=True)
+        if regressions:
+            raise SystemExit(1)
+
+
+def init_app(app):
+    for command in cli.commands.values():
+        app.cli.add_command(command)
+
+
+@cli.command('load-test')
+@click.option('--workers', 'worker_counts', default='1,2,4', help='Comma separated numbers of gunicorn workers.')
+@click.option('--threads', default=4, help='Threads per worker.')
+@click.option('--concurrency', default=16, help='Concurrent client connections.')
+@click.option('--duration', default=10.0, help='Seconds of load per worker count.')
+@click.option('--path', 'paths', multiple=True, help='Route to request, the benchmarked routes by default.')
+def load_test(worker_counts, threads, concurrency, duration, paths):
+    """Runs gunicorn with every number of workers and measures throughput under concurrent load."""
+    paths = list(paths) or bench_routes(Session())
+    click.echo('{:>8} {:>9} {:>8} {:>9} {:>9} {:>7}'.format('workers', 'requests', 'rps', 'p50 ms', 'p99 ms', 'errors'))
+    try:
+        for workers, result in scaling_test(current_app._get_current_object(), paths,
+                                            [int(count) for count in worker_counts.split(',')],
+                                            threads, concurrency, duration):
+            click.echo('{:>8} {requests:>9} {rps:>8} {p50_ms:>9} {p99_ms:>9} {errors:>7}'.format(workers, **result))
+    except LoadTestError as e:
+        raise click.ClickException(str(e))
@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 STUFF = {'pri': [
                  ['Меч Ученика', 'grade0', None], ['Короткий меч', 'grade0', None], ['Длинный меч', 'grade0', None],
                  ['Меч Вдовы', 'grade0', None], ['Меч Рыцаря', 'grade0', None],
@@ -64,6 +66,9 @@ STUFF = {'pri': [
          }
 
 EQUIP_PARTS = ['pri', 'sec', 'head', 'arms', 'armor', 'legs', 'special']
+EQUIP_PART_TITLES = {'pri': 'Пр. рука', 'sec': 'Л. рука', 'head': 'Шлем', 'arms': 'Перчатки', 'armor': 'Броня',
+                     'legs': 'Сапоги', 'special': 'Особое'}
+EQUIP_CHANGES_PERIOD = timedelta(days=7)
 
 COLORS = {'color_off': None,
           'grade0': None,
@@ -76,4 +81,11 @@ COLORS = {'color_off': None,
 
 PROFILE_FRESH = '✓'
 PROFILE_NOT_FRESH = '✖'
+PROFILE_FRESH_PERIOD = timedelta(days=7)
 MSG_UNDER_CONSTRUCTION = 'Страница находится в разработке'
+
+TOP_METRICS = [('level', '🏅 Уровень'), ('exp', '🔥 Опыт'), ('attack', '⚔️ Атака'), ('defence', '🛡 Защита'),
+               ('gold', '💰 Золото'), ('earned_exp', '🔥 Опыт за битву'), ('earned_gold', '💰 Золото за битву')]
+
+PLAYER_METRICS = [('level', '🏅 Уровень'), ('exp', '🔥 Опыт'), ('attack', '⚔️ Атака'), ('defence', '🛡 Защита'),
+                  ('gold', '💰 Золото')]
@@ -0,0 +1,127 @@
+import re
+
+import config
+from app.cache import ParseCache
+from app.constants import STUFF, EQUIP_PARTS, COLORS
+
+EMPTY_SLOT = [' ', None]
+
+
+def _trie_pattern(words):
+    """Builds a regex alternation shaped like a trie, so that the regex engine
+    checks one character per position instead of every word in turn.
+    Greedy optional groups make it return the longest word at a position.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return '(?:' + body + ')?' if '' in node else body
+
+    return build(trie)
+
+
+def _has_overlaps(words):
+    """True if some word can start inside another one and run past its end."""
+    for first in words:
+        for k in range(1, len(first)):
+            tail = first[k:]
+            for second in words:
+                if len(second) > len(tail) and second.startswith(tail):
+                    return True
+    return False
+
+
+class EquipMatcher(object):
+    """Precompiled matcher for the equip text of a character.
+
+    Gives the same result as checking every slot, then every item of STUFF in
+    order, then every line of the text with `item in line`: the first item of a
+    slot present in the text wins, and the text before it in its line is kept
+    as the modifier.
+    """
+
+    def __init__(self, stuff=STUFF, parts=EQUIP_PARTS, colors=COLORS):
+        self.parts = list(parts)
+        self.colors = colors
+        # item -> [(slot, rank, shown text, grade)]
+        self.ranks = {}
+        for slot, part in enumerate(self.parts):
+            for rank, (item, grade, alias) in enumerate(stuff[part]):
+                self.ranks.setdefault(item, []).append((slot, rank, alias or item, grade))
+        items = sorted(self.ranks, key=len, reverse=True)
+        # Короткие предметы, целиком входящие в найденный, тоже считаются найденными
+        self.contained = {item: [other for other in items if other in item] for item in items}
+        pattern = _trie_pattern(items)
+        if _has_overlaps(items):
+            # Нужен поиск с каждой позиции, иначе пересекающиеся названия потеряются
+            pattern = '(?=(' + pattern + '))'
+        self.regex = re.compile(pattern)
+
+    def slots(self, text):
+        """Returns a list with one (shown text with modifier, grade) pair per slot of EQUIP_PARTS,
+        None for empty slots.
+        """
+        if not text:
+            return [None] * len(self.parts)
+        best = [None] * len(self.parts)
+        for found in set(self.regex.findall(text)):
+            for item in self.contained[found]:
+                for slot, rank, shown, grade in self.ranks[item]:
+                    if best[slot] is None or rank < best[slot][0]:
+                        best[slot] = (rank, item, shown, grade)
+        result = []
+        for winner in best:
+            if winner is None:
+                result.append(None)
+                continue
+            rank, item, shown, grade = winner
+            pos = text.find(item)
+            line_start = text.rfind('\n', 0, pos) + 1
+            result.append((text[line_start:pos] + shown, grade))
+        return result
+
+    def match(self, text):
+        """Returns a list of [item, color] pairs, one per slot of EQUIP_PARTS."""
+        return [[shown, self.colors[grade]] if shown is not None else list(EMPTY_SLOT)
+                for shown, grade in (slot or (None, None) for slot in self.slots(text))]
+
+EQUIP_MATCHER = EquipMatcher()
+
+
+def parse_equip(text):
+    return EQUIP_MATCHER.match(text)
+
+
+# Разобранная экипировка по ключу строки Equip (user_id, date)
+EQUIP_CACHE = ParseCache(parse_equip, getattr(config, 'EQUIP_CACHE_SIZE', 5000))
+
+
+def get_parsed_equip(user_id, date, text):
+    """Parsed equip of the Equip row with primary key (user_id, date), see ParseCache."""
+    return EQUIP_CACHE.parse((user_id, date) if date is not None else None, text)
+
+
+def equip_changes(old_text, new_text):
+    """[(part, old item, new item, upgrade)] for every slot that differs between two equip texts.
+
+    Items are shown with their modifiers, None for an empty slot. A change is an
+    upgrade if the slot was empty or the new item has a higher grade.
+    """
+    changes = []
+    old_slots = EQUIP_MATCHER.slots(old_text)
+    new_slots = EQUIP_MATCHER.slots(new_text)
+    for part, old, new in zip(EQUIP_MATCHER.parts, old_slots, new_slots):
+        if old == new:
+            continue
+        upgrade = new is not None and (old is None or new[1] > old[1])
+        changes.append((part, old and old[0], new and new[0], upgrade))
+    return changes
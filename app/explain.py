@@ -0,0 +1,68 @@
+import re
+
+from datetime import datetime
+
+from app.constants import EQUIP_CHANGES_PERIOD, PLAYER_METRICS
+from app.queries import (users_query, users_count_query, squads_query, squad_members_query, squad_stock_query,
+                         snapshot_watermark_query, battle_rollups, squad_size_query, player_reports, build_progress,
+                         build_buckets_query, build_contributors, build_squad_contributions, player_history,
+                         squad_equip_changes)
+from app.types import Character, Equip, Stock
+
+# Таблицы истории, полный проход по которым недопустим
+LARGE_TABLES = {'characters', 'equip', 'stock', 'reports', 'build_reports', 'log'}
+
+SQLITE_SCAN = re.compile(r'SCAN (?:TABLE )?(\w+)')
+# Полный проход по индексу тоже растёт вместе с историей
+MYSQL_SCAN_TYPES = {'ALL', 'index'}
+
+
+def view_queries(session, squad_id=0, user_id=0, building=''):
+    """Queries issued by the views, built by the same functions the views use."""
+    yield 'squads', squads_query(session)
+    yield 'users', users_query(session)
+    yield 'users-page', users_query(session, after=(0, 0))
+    yield 'users-count', users_count_query(session)
+    yield 'member-equip', squad_members_query(session, squad_id)
+    yield 'squad-stock', squad_stock_query(session, squad_id)
+    yield 'equip-changes', squad_equip_changes(session, squad_id, datetime.now() - EQUIP_CHANGES_PERIOD)
+    yield 'snapshot-watermark', snapshot_watermark_query(session, Character, Equip, Stock)
+    yield 'battle-rollups', battle_rollups(session, squad_id)
+    yield 'squad-size', squad_size_query(session, squad_id)
+    yield 'player-reports', player_reports(session, user_id)
+    yield 'player-history', player_history(session, user_id, [metric for metric, title in PLAYER_METRICS])
+    yield 'build-progress', build_progress(session)
+    yield 'build-series', build_buckets_query(session, building, 1, 48)
+    yield 'build-contributors', build_contributors(session, building, 10)
+    yield 'build-squad-contributions', build_squad_contributions(session, building)
+
+
+def explain(connection, query):
+    """Returns the plan of `query` as a list of rows."""
+    compiled = query.statement.compile(dialect=connection.dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN '
+    return connection.execute(prefix + str(compiled), params).fetchall()
+
+
+def full_scans(connection, plan):
+    """Names of large tables read from start to end in `plan`."""
+    scans = []
+    for row in plan:
+        if connection.dialect.name == 'sqlite':
+            match = SQLITE_SCAN.search(row[-1])
+            if match:
+                scans.append(match.group(1))
+        elif row['type'] in MYSQL_SCAN_TYPES and row['table']:
+            scans.append(re.sub(r'_\d+$', '', row['table']))
+    return [table for table in scans if table in LARGE_TABLES]
+
+
+def check_queries(session, squad_id=0, user_id=0, building=''):
+    """Yields (view name, plan, full scans) for every view query."""
+    connection = session.connection()
+    for name, query in view_queries(session, squad_id, user_id, building):
+        plan = explain(connection, query)
+        yield name, plan, full_scans(connection, plan)
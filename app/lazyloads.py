@@ -0,0 +1,120 @@
+import logging
+import os
+import sys
+from contextlib import contextmanager
+from threading import local
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.strategies import LazyLoader
+
+import config
+
+LOGGER = logging.getLogger(__name__)
+# Считать ленивые загрузки связей в каждом запросе и писать их в лог
+DEBUG_LAZY_LOADS = getattr(config, 'DEBUG_LAZY_LOADS', False)
+# Допустимое число SQL-запросов по имени endpoint, например {'views.get_member_equip': 5}
+QUERY_BUDGETS = getattr(config, 'QUERY_BUDGETS', {})
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryAudit(object):
+    """Queries and lazy loads issued while the audit is active."""
+
+    def __init__(self):
+        self.queries = 0
+        self.lazy_loads = []
+
+    def report(self):
+        return '\n'.join('{} loaded from {}'.format(relationship, location)
+                         for relationship, location in self.lazy_loads)
+
+
+_audits = local()
+
+
+def active_audits():
+    if not hasattr(_audits, 'stack'):
+        _audits.stack = []
+    return _audits.stack
+
+
+def lazy_load_origin(frame):
+    """(relationship, template or code line) of the lazy load running the query, None if it is not one."""
+    relationship = None
+    while frame is not None:
+        if relationship is None:
+            if frame.f_code.co_name == '_load_for_state' and isinstance(frame.f_locals.get('self'), LazyLoader):
+                relationship = str(frame.f_locals['self'].parent_property)
+        else:
+            template = frame.f_globals.get('__jinja_template__')
+            if template is not None:
+                return relationship, '{}:{}'.format(template.name or '<string>',
+                                                   template.get_corresponding_lineno(frame.f_lineno))
+            if frame.f_code.co_filename.startswith(APP_DIR):
+                return relationship, '{}:{}'.format(os.path.relpath(frame.f_code.co_filename, APP_DIR), frame.f_lineno)
+        frame = frame.f_back
+    if relationship is not None:
+        return relationship, 'unknown'
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def audit_query(conn, cursor, statement, parameters, context, executemany):
+    audits = active_audits()
+    if not audits:
+        return
+    origin = lazy_load_origin(sys._getframe(1))
+    for audit in audits:
+        audit.queries += 1
+        if origin is not None:
+            audit.lazy_loads.append(origin)
+
+
+@contextmanager
+def query_budget(max_queries=None, max_lazy_loads=None):
+    """Fails with QueryBudgetExceeded if the block issues more queries or lazy loads than allowed.
+
+        with query_budget(max_queries=4, max_lazy_loads=0):
+            client.get('/member-equip/1')
+    """
+    audit = QueryAudit()
+    active_audits().append(audit)
+    try:
+        yield audit
+    finally:
+        active_audits().remove(audit)
+    if max_queries is not None and audit.queries > max_queries:
+        raise QueryBudgetExceeded('{} queries, budget is {}\n{}'.format(audit.queries, max_queries, audit.report()))
+    if max_lazy_loads is not None and len(audit.lazy_loads) > max_lazy_loads:
+        raise QueryBudgetExceeded('{} lazy loads, budget is {}\n{}'.format(len(audit.lazy_loads), max_lazy_loads,
+                                                                           audit.report()))
+
+
+def start_query_audit():
+    g.query_audit = QueryAudit()
+    active_audits().append(g.query_audit)
+
+
+def finish_query_audit(exc):
+    audit = g.pop('query_audit', None)
+    if audit is None:
+        return
+    active_audits().remove(audit)
+    if audit.lazy_loads:
+        LOGGER.warning('%s: %d lazy loads\n%s', request.endpoint, len(audit.lazy_loads), audit.report())
+    budget = QUERY_BUDGETS.get(request.endpoint)
+    if budget is not None and audit.queries > budget:
+        LOGGER.error('%s: %d queries, budget is %d', request.endpoint, audit.queries, budget)
+
+
+def init_app(app):
+    if DEBUG_LAZY_LOADS:
+        app.before_request(start_query_audit)
+        app.teardown_request(finish_query_audit)
@@ -0,0 +1,148 @@
+from bisect import bisect_left, insort
+from threading import Lock
+from time import time
+
+import config
+from config import CASTLE
+from app.constants import TOP_METRICS
+from app.queries import snapshot_model, filter_latest
+from app.types import Character, Report, SquadMember, battle_time
+
+CHARACTER_METRICS = ['level', 'exp', 'attack', 'defence', 'gold']
+BATTLE_METRICS = ['earned_exp', 'earned_gold']
+# Как часто (в секундах) подтягивать новые профили и репорты
+TOP_REFRESH_INTERVAL = getattr(config, 'TOP_REFRESH_INTERVAL', 10)
+
+
+class Ranking(object):
+    """Players sorted by one value, kept sorted as values change."""
+
+    def __init__(self):
+        self.entries = []
+        self.values = {}
+
+    def update(self, user_id, value):
+        self.remove(user_id)
+        if value is None:
+            return
+        self.values[user_id] = value
+        insort(self.entries, (-value, user_id))
+
+    def remove(self, user_id):
+        value = self.values.pop(user_id, None)
+        if value is not None:
+            del self.entries[bisect_left(self.entries, (-value, user_id))]
+
+    def top(self, limit, allowed=None):
+        """Best `limit` (user_id, value) pairs, only of `allowed` users if given."""
+        result = []
+        for value, user_id in self.entries:
+            if allowed is None or user_id in allowed:
+                result.append((user_id, -value))
+                if len(result) == limit:
+                    break
+        return result
+
+    def clear(self):
+        self.entries = []
+        self.values = {}
+
+
+class Leaderboards(object):
+    """Castle tops kept in memory.
+
+    Loaded once from the newest snapshots, then only profiles and reports
+    written after the newest seen date are fetched, at most every
+    `refresh_interval` seconds.
+    """
+
+    def __init__(self, refresh_interval=TOP_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.rankings = {metric: Ranking() for metric, title in TOP_METRICS}
+        self.names = {}
+        self.dates = {}
+        self.squads = {}
+        self.battle = None
+        self._newest_character = None
+        self._newest_report = None
+        self._refreshed_at = 0
+        self._refresh_lock = Lock()
+        self._lock = Lock()
+
+    def refresh(self, session):
+        """Fetches new profiles and reports if the interval has passed.
+
+        While one thread refreshes, the others keep serving the current rankings;
+        only the first load is waited for.
+        """
+        if time() - self._refreshed_at < self.refresh_interval:
+            return
+        if not self._refresh_lock.acquire(not self._refreshed_at):
+            return
+        try:
+            if time() - self._refreshed_at < self.refresh_interval:
+                return
+            if self._newest_character is None:
+                CharacterSnapshot = snapshot_model(Character)
+                characters = filter_latest(session.query(CharacterSnapshot), CharacterSnapshot)
+            else:
+                CharacterSnapshot = Character
+                characters = session.query(Character).filter(Character.date > self._newest_character)
+            characters = characters.order_by(CharacterSnapshot.date).all()
+            newest_character = characters[-1].date if characters else self._newest_character
+            reports = session.query(Report)
+            if self._newest_report is not None:
+                reports = reports.filter(Report.date > self._newest_report)
+            elif newest_character is not None:
+                # Для первой загрузки хватит репортов последней битвы
+                reports = reports.filter(Report.date >= battle_time(newest_character))
+            reports = reports.order_by(Report.date).all()
+            squads = dict(session.query(SquadMember.user_id, SquadMember.squad_id))
+            # Запросы идут без блокировки рейтингов, top() ждёт только их обновления в памяти
+            with self._lock:
+                for character in characters:
+                    self.add_character(character)
+                for report in reports:
+                    self.add_report(report)
+                self.squads = squads
+            self._refreshed_at = time()
+        finally:
+            self._refresh_lock.release()
+
+    def add_character(self, character):
+        if character.user_id in self.dates and self.dates[character.user_id] >= character.date:
+            return
+        self.dates[character.user_id] = character.date
+        self.names[character.user_id] = character.name
+        if self._newest_character is None or character.date > self._newest_character:
+            self._newest_character = character.date
+        for metric in CHARACTER_METRICS:
+            value = getattr(character, metric) if not CASTLE or character.castle == CASTLE else None
+            self.rankings[metric].update(character.user_id, value)
+
+    def add_report(self, report):
+        if self._newest_report is None or report.date > self._newest_report:
+            self._newest_report = report.date
+        battle = battle_time(report.date)
+        if self.battle is None or battle > self.battle:
+            self.battle = battle
+            for metric in BATTLE_METRICS:
+                self.rankings[metric].clear()
+        elif battle < self.battle or report.user_id in self.rankings[BATTLE_METRICS[0]].values:
+            return
+        if CASTLE and report.castle != CASTLE:
+            return
+        for metric in BATTLE_METRICS:
+            self.rankings[metric].update(report.user_id, getattr(report, metric))
+
+    def top(self, metric, limit=10, squad_id=None):
+        """[(user_id, name, value)] of the best players by `metric`."""
+        allowed = None
+        if squad_id is not None:
+            allowed = {user_id for user_id, squad in self.squads.items() if squad == squad_id}
+        with self._lock:
+            return [(user_id, self.names.get(user_id, ''), value)
+                    for user_id, value in self.rankings[metric].top(limit, allowed)]
+
+
+LEADERBOARDS = Leaderboards()
@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+from http.client import HTTPConnection
+from threading import Thread
+from time import perf_counter, sleep
+
+from app.bench import auth_headers, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LoadTestError(Exception):
+    pass
+
+
+def session_cookie(app, user_id=1):
+    """Cookie header of a signed-in session of the user."""
+    value = app.session_interface.get_signing_serializer(app).dumps({'user_id': user_id})
+    return '{}={}'.format(app.session_cookie_name, value)
+
+
+def run_load(host, port, paths, headers, concurrency=16, duration=10.0):
+    """Requests `paths` in turn from `concurrency` keep-alive connections for `duration` seconds.
+
+    Returns {requests, errors, rps, p50_ms, p99_ms}.
+    """
+    deadline = perf_counter() + duration
+    results = [([], [0]) for _ in range(concurrency)]
+
+    def client(times, errors):
+        connection = HTTPConnection(host, port, timeout=30)
+        number = 0
+        while perf_counter() < deadline:
+            path = paths[number % len(paths)]
+            number += 1
+            started = perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors[0] += 1
+                    continue
+            except (OSError, IOError):
+                errors[0] += 1
+                connection.close()
+                connection = HTTPConnection(host, port, timeout=30)
+                continue
+            times.append(perf_counter() - started)
+        connection.close()
+
+    threads = [Thread(target=client, args=result) for result in results]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - started
+    times = [time for result in results for time in result[0]]
+    if not times:
+        raise LoadTestError('no request succeeded')
+    return {'requests': len(times), 'errors': sum(result[1][0] for result in results),
+            'rps': round(len(times) / elapsed, 1), 'p50_ms': round(percentile(times, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(times, 0.99) * 1000, 2)}
+
+
+def start_server(port, workers, threads, timeout=30.0):
+    """Starts gunicorn with wsgi:app and waits until it answers."""
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind',
+                               '127.0.0.1:{}'.format(port), '--workers', str(workers), '--threads', str(threads),
+                               'wsgi:app'], cwd=ROOT)
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        if server.poll() is not None:
+            raise LoadTestError('gunicorn exited with code {}'.format(server.returncode))
+        try:
+            connection = HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/robots.txt')
+            connection.getresponse().read()
+            connection.close()
+            return server
+        except (OSError, IOError):
+            sleep(0.2)
+    stop_server(server)
+    raise LoadTestError('gunicorn did not answer in {} seconds'.format(timeout))
+
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+
+def scaling_test(app, paths, worker_counts, threads=4, concurrency=16, duration=10.0, port=5099):
+    """Yields (workers, load results) for a gunicorn started with every number of workers in turn."""
+    headers = dict(auth_headers(), Cookie=session_cookie(app))
+    for workers in worker_counts:
+        server = start_server(port, workers, threads)
+        try:
+            yield workers, run_load('127.0.0.1', port, paths, headers, concurrency, duration)
+        finally:
+            stop_server(server)
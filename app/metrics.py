@@ -0,0 +1,148 @@
+import logging
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import config
+
+LOGGER = logging.getLogger(__name__)
+# Запросы дольше этого (в миллисекундах) пишутся в лог вместе со своими SQL-запросами, None - выключено
+SLOW_REQUEST_MS = getattr(config, 'SLOW_REQUEST_MS', None)
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    """Prometheus-style histogram with one series per route."""
+
+    def __init__(self, name, description, buckets=TIME_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series = {}
+        self._lock = Lock()
+
+    def observe(self, route, value):
+        with self._lock:
+            counts, total = self.series.get(route, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.series[route] = (counts, total + value)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((route, list(counts), total) for route, (counts, total) in self.series.items())
+        for route, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{{route="{}",le="{}"}} {}'.format(self.name, route, bound, cumulative))
+            lines.append('{}_sum{{route="{}"}} {}'.format(self.name, route, total))
+            lines.append('{}_count{{route="{}"}} {}'.format(self.name, route, cumulative))
+        return lines
+
+
+def render_value(name, kind, description, value):
+    """Lines of a single counter or gauge."""
+    return ['# HELP {} {}'.format(name, description),
+            '# TYPE {} {}'.format(name, kind),
+            '{} {}'.format(name, value)]
+
+
+class RequestMetrics(object):
+    """Counters of a single request, kept in flask.g."""
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.statements = [] if SLOW_REQUEST_MS is not None else None
+
+
+REQUEST_TIME = Histogram('castlestats_request_seconds', 'Total request time.')
+SQL_TIME = Histogram('castlestats_request_sql_seconds', 'Time spent in SQL queries per request.')
+RENDER_TIME = Histogram('castlestats_request_render_seconds', 'Time spent rendering Jinja templates per request.')
+PYTHON_TIME = Histogram('castlestats_request_python_seconds', 'Request time outside of SQL and templates.')
+SQL_QUERIES = Histogram('castlestats_request_sql_queries', 'SQL queries per request.', COUNT_BUCKETS)
+HISTOGRAMS = [REQUEST_TIME, SQL_TIME, RENDER_TIME, PYTHON_TIME, SQL_QUERIES]
+
+# Дополнительные метрики: функции, возвращающие строки в формате Prometheus
+COLLECTORS = []
+
+
+def current_metrics():
+    if has_request_context():
+        return getattr(g, 'metrics', None)
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_start'].pop()
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.sql_count += 1
+        metrics.sql_time += elapsed
+        if metrics.statements is not None:
+            metrics.statements.append((elapsed, statement))
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            metrics = current_metrics()
+            if metrics is not None:
+                metrics.render_time += perf_counter() - start
+
+
+def start_request_metrics():
+    g.metrics = RequestMetrics()
+
+
+def finish_request_metrics(exc):
+    metrics = current_metrics()
+    if metrics is None:
+        return
+    total = perf_counter() - metrics.start
+    route = request.endpoint or 'unknown'
+    REQUEST_TIME.observe(route, total)
+    SQL_TIME.observe(route, metrics.sql_time)
+    RENDER_TIME.observe(route, metrics.render_time)
+    PYTHON_TIME.observe(route, max(total - metrics.sql_time - metrics.render_time, 0))
+    SQL_QUERIES.observe(route, metrics.sql_count)
+    if metrics.statements is not None and total * 1000 >= SLOW_REQUEST_MS:
+        LOGGER.warning('Slow request %s %.1f ms, %d queries, %.1f ms in SQL:\n%s',
+                       request.full_path, total * 1000, metrics.sql_count, metrics.sql_time * 1000,
+                       '\n'.join('{:.1f} ms: {}'.format(elapsed * 1000, statement)
+                                 for elapsed, statement in metrics.statements))
+
+
+def init_app(app):
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_request_metrics)
+    app.teardown_request(finish_request_metrics)
+
+
+def render_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for collector in COLLECTORS:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
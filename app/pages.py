@@ -0,0 +1,63 @@
+import os
+import zlib
+from datetime import datetime
+from hashlib import sha1
+
+from flask import Response, render_template, request
+
+import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Сколько секунд браузеры и прокси могут не перезапрашивать статические страницы
+STATIC_PAGES_MAX_AGE = getattr(config, 'STATIC_PAGES_MAX_AGE', 86400)
+
+
+def gzip_compress(data):
+    # Без времени в заголовке gzip, чтобы у всех воркеров получались одинаковые байты
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class StaticPage(object):
+    """A page rendered once, kept with its compressed variants and validators."""
+
+    def __init__(self, body, last_modified):
+        body = body.encode('utf-8')
+        self.etag = sha1(body).hexdigest()
+        self.last_modified = last_modified
+        self.variants = {'identity': body, 'gzip': gzip_compress(body)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body)
+
+    def encoding(self, accept_encodings):
+        """The smallest variant the client accepts."""
+        accepted = [name for name in self.variants if name == 'identity' or accept_encodings[name]]
+        return min(accepted, key=lambda name: len(self.variants[name]))
+
+    def response(self):
+        """Response to the current request, 304 if the client has this variant already."""
+        encoding = self.encoding(request.accept_encodings)
+        response = Response(self.variants[encoding], mimetype='text/html')
+        if encoding != 'identity':
+            response.content_encoding = encoding
+        response.set_etag('{}-{}'.format(self.etag, encoding))
+        response.last_modified = self.last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_PAGES_MAX_AGE
+        response.vary.add('Accept-Encoding')
+        return response.make_conditional(request)
+
+
+def render_static_pages(app, templates):
+    """{template: StaticPage} of templates that do not depend on the request."""
+    pages = {}
+    with app.app_context():
+        for template in templates:
+            filename = app.jinja_env.get_template(template).filename
+            last_modified = datetime.utcfromtimestamp(int(os.path.getmtime(filename)))
+            pages[template] = StaticPage(render_template(template), last_modified)
+    return pages
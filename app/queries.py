@@ -0,0 +1,213 @@
+from datetime import datetime
+
+from sqlalchemy import func, tuple_, select, and_, or_, case
+from sqlalchemy.orm import joinedload
+
+from config import CASTLE
+from app.constants import PROFILE_FRESH_PERIOD
+from app.types import (LATEST_MODELS, LATEST_SNAPSHOTS, Character, Equip, EquipChange, Stock, User, Squad, SquadMember,
+                       Report, BattleRollup, BuildBucket, BuildContribution)
+
+# Уровень, под которым в /users идут игроки без уровня: после всех остальных
+NO_LEVEL = -1
+
+
+def snapshot_model(model):
+    """Model to read the newest snapshots of `model` from; models without a latest table are read as is."""
+    if LATEST_SNAPSHOTS:
+        return LATEST_MODELS.get(model, model)
+    return model
+
+
+def filter_latest(query, model, outer=False, users=None):
+    """Restricts `query` to the newest row of `model` per user.
+
+    `model` is what snapshot_model() returned; latest tables need no filter.
+    With `outer` rows where `model` was outer-joined to nothing are kept.
+    `users` is a select of the user ids the query can return, so that the
+    newest rows are looked up only for them instead of the whole history.
+    """
+    if model in LATEST_MODELS.values():
+        return query
+    newest = query.session.query(model.user_id, func.max(model.date))
+    if users is not None:
+        newest = newest.filter(model.user_id.in_(users))
+    newest = newest.group_by(model.user_id).subquery()
+    condition = tuple_(model.user_id, model.date).in_(newest)
+    if outer:
+        condition = condition | model.user_id.is_(None)
+    return query.filter(condition)
+
+
+def squads_query(session):
+    """Every squad once with its member count, total attack and defence,
+    average level and number of fresh profiles of the members.
+    """
+    CharacterSnapshot = snapshot_model(Character)
+    fresh_since = datetime.now() - PROFILE_FRESH_PERIOD
+    squads = session.query(Squad,
+                           func.count(CharacterSnapshot.user_id).label('members'),
+                           func.sum(CharacterSnapshot.attack).label('attack'),
+                           func.sum(CharacterSnapshot.defence).label('defence'),
+                           func.avg(CharacterSnapshot.level).label('avg_level'),
+                           func.sum(case([(CharacterSnapshot.date > fresh_since, 1)], else_=0)).label('fresh')) \
+        .join(SquadMember, SquadMember.squad_id == Squad.chat_id) \
+        .join(CharacterSnapshot, CharacterSnapshot.user_id == SquadMember.user_id)
+    squads = filter_latest(squads, CharacterSnapshot)
+    if CASTLE:
+        squads = squads.filter(CharacterSnapshot.castle == CASTLE)
+    return squads.group_by(Squad.chat_id).order_by(Squad.squad_name)
+
+
+def users_cursor(character):
+    """(level, user_id) of `character` in the order of users_query()."""
+    return (character.level if character.level is not None else NO_LEVEL), character.user_id
+
+
+def users_query(session, after=None):
+    """Newest Character of every player together with its User, by level and user id descending.
+
+    `after` is the users_cursor() of the last row of the previous page.
+    """
+    CharacterSnapshot = snapshot_model(Character)
+    characters = session.query(CharacterSnapshot, User).join(User, User.id == CharacterSnapshot.user_id)
+    characters = filter_latest(characters, CharacterSnapshot)
+    if CASTLE:
+        characters = characters.filter(CharacterSnapshot.castle == CASTLE)
+    level = func.coalesce(CharacterSnapshot.level, NO_LEVEL)
+    if after:
+        after_level, after_user_id = after
+        characters = characters.filter(or_(level < after_level,
+                                           and_(level == after_level, CharacterSnapshot.user_id < after_user_id)))
+    return characters.order_by(level.desc(), CharacterSnapshot.user_id.desc())
+
+
+def users_count_query(session):
+    CharacterSnapshot = snapshot_model(Character)
+    count = session.query(func.count(CharacterSnapshot.user_id))
+    count = filter_latest(count, CharacterSnapshot)
+    if CASTLE:
+        count = count.filter(CharacterSnapshot.castle == CASTLE)
+    return count
+
+
+def users_count(session):
+    return users_count_query(session).scalar()
+
+
+def squad_members_query(session, squad_id):
+    """Newest Character, User and newest (date, equip) of every member of the squad."""
+    CharacterSnapshot = snapshot_model(Character)
+    EquipSnapshot = snapshot_model(Equip)
+    members = session.query(CharacterSnapshot, User, EquipSnapshot.date, EquipSnapshot.equip) \
+        .join(User, User.id == CharacterSnapshot.user_id) \
+        .outerjoin(EquipSnapshot, User.id == EquipSnapshot.user_id) \
+        .join(SquadMember, SquadMember.user_id == CharacterSnapshot.user_id) \
+        .filter(SquadMember.squad_id == squad_id) \
+        .order_by(CharacterSnapshot.level.desc())
+    members = filter_latest(members, CharacterSnapshot)
+    members = filter_latest(members, EquipSnapshot, outer=True)
+    if CASTLE:
+        members = members.filter(CharacterSnapshot.castle == CASTLE)
+    return members
+
+
+def squad_stock_query(session, squad_id):
+    """(stock id, stock text, User) of the newest Stock of every member of the squad."""
+    members = select([SquadMember.user_id]).where(SquadMember.squad_id == squad_id)
+    stock = session.query(Stock.id, Stock.stock, User) \
+        .join(User, User.id == Stock.user_id) \
+        .join(SquadMember, SquadMember.user_id == Stock.user_id) \
+        .filter(SquadMember.squad_id == squad_id)
+    return filter_latest(stock, Stock, users=members)
+
+
+def snapshot_watermark_query(session, *models):
+    newest = [select([func.max(snapshot_model(model).date)]).as_scalar() for model in models]
+    return session.query(*newest)
+
+
+def snapshot_watermark(session, *models):
+    """Newest snapshot date of every model, fetched in one query.
+
+    Changes whenever the bot writes a new snapshot, so it marks cached pages stale.
+    """
+    return tuple(snapshot_watermark_query(session, *models).one())
+
+
+def with_latest_snapshots(query, *relationships):
+    """Loads the newest snapshots of every User in `query` together with the users,
+    in the same query, instead of one lazy load per user and relationship.
+
+        with_latest_snapshots(session.query(User), User.character, User.equip)
+    """
+    return query.options(*[joinedload(relationship) for relationship in relationships])
+
+
+def battle_rollups(session, squad_id=0, limit=20):
+    """Totals of the last `limit` battles for the castle or a squad."""
+    return session.query(BattleRollup).filter(BattleRollup.squad_id == squad_id) \
+        .order_by(BattleRollup.battle.desc()).limit(limit)
+
+
+def squad_size_query(session, squad_id):
+    return session.query(func.count(SquadMember.user_id)).filter(SquadMember.squad_id == squad_id)
+
+
+def squad_size(session, squad_id):
+    return squad_size_query(session, squad_id).scalar()
+
+
+def player_reports(session, user_id, limit=20):
+    """Last `limit` reports of the player, newest first."""
+    return session.query(Report).filter(Report.user_id == user_id).order_by(Report.date.desc()).limit(limit)
+
+
+def build_progress(session):
+    """(building, progress, last_date) of every building from its newest hourly bucket."""
+    newest = session.query(BuildBucket.building, func.max(BuildBucket.start).label('start')) \
+        .filter(BuildBucket.hours == 1).group_by(BuildBucket.building).subquery()
+    return session.query(BuildBucket.building, BuildBucket.progress, BuildBucket.last_date) \
+        .join(newest, and_(BuildBucket.building == newest.c.building, BuildBucket.start == newest.c.start)) \
+        .filter(BuildBucket.hours == 1).order_by(BuildBucket.last_date.desc())
+
+
+def build_buckets_query(session, building, hours, limit):
+    """Last `limit` buckets of `hours` hours of the building, newest first."""
+    return session.query(BuildBucket).filter(BuildBucket.building == building, BuildBucket.hours == hours) \
+        .order_by(BuildBucket.start.desc()).limit(limit)
+
+
+def build_series(session, building, hours, limit):
+    """Last `limit` buckets of `hours` hours of the building, oldest first."""
+    return build_buckets_query(session, building, hours, limit).all()[::-1]
+
+
+def build_contributors(session, building, limit):
+    """(BuildContribution, User) of the players who sent most reports about the building."""
+    return session.query(BuildContribution, User).join(User, User.id == BuildContribution.user_id) \
+        .filter(BuildContribution.building == building) \
+        .order_by(BuildContribution.reports.desc()).limit(limit)
+
+
+def build_squad_contributions(session, building):
+    """(Squad, reports, players) of every squad that worked on the building."""
+    return session.query(Squad, func.sum(BuildContribution.reports), func.count(BuildContribution.user_id)) \
+        .join(SquadMember, SquadMember.squad_id == Squad.chat_id) \
+        .join(BuildContribution, BuildContribution.user_id == SquadMember.user_id) \
+        .filter(BuildContribution.building == building) \
+        .group_by(Squad.chat_id).order_by(func.sum(BuildContribution.reports).desc())
+
+
+def player_history(session, user_id, metrics):
+    """(date, *metrics) of every profile snapshot of the player, oldest first."""
+    return session.query(Character.date, *[getattr(Character, metric) for metric in metrics]) \
+        .filter(Character.user_id == user_id).order_by(Character.date)
+
+
+def squad_equip_changes(session, squad_id, since):
+    """(EquipChange, User) of the members of the squad since `since`, newest first."""
+    return session.query(EquipChange, User).join(User, User.id == EquipChange.user_id) \
+        .join(SquadMember, SquadMember.user_id == EquipChange.user_id) \
+        .filter(SquadMember.squad_id == squad_id, EquipChange.date >= since) \
+        .order_by(EquipChange.date.desc(), EquipChange.user_id, EquipChange.slot)
@@ -0,0 +1,123 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, tuple_
+
+import config
+from app.charts import EPOCH
+from app.types import Character, Equip, Stock, Report, BuildReport
+
+# Правила хранения истории: [(возраст, период)] от младших к старшим.
+# Строки младше `возраста` прореживаются до последней за `период` у каждого игрока (None - хранить все),
+# строки старше последнего правила уходят в архив целиком; возраст None - без ограничения.
+DEFAULT_RETENTION = [(timedelta(days=30), None), (timedelta(days=365), timedelta(days=1)), (None, timedelta(weeks=1))]
+RETENTION = getattr(config, 'RETENTION', {'characters': DEFAULT_RETENTION, 'equip': DEFAULT_RETENTION,
+                                          'stock': DEFAULT_RETENTION})
+RETENTION_ARCHIVE_DIR = getattr(config, 'RETENTION_ARCHIVE_DIR', 'archive')
+# Сколько строк удалять за одну транзакцию
+RETENTION_BATCH = getattr(config, 'RETENTION_BATCH', 1000)
+RETENTION_USERS = 200
+
+HISTORY_MODELS = {model.__tablename__: model for model in [Character, Equip, Stock, Report, BuildReport]}
+
+
+def rule_period(rules, age):
+    """Period to keep one row per for a row of age `age`, None to keep every row,
+    False if the row is older than every rule.
+    """
+    for max_age, period in rules:
+        if max_age is None or age < max_age:
+            return period
+    return False
+
+
+def expired_rows(rows, rules, now):
+    """Keys of the (key, user_id, date) rows that the rules do not keep; rows must be ordered
+    by user and newest first. The newest row of every period is kept.
+    """
+    expired = []
+    user, seen = None, set()
+    for key, user_id, date in rows:
+        if user_id != user:
+            user, seen = user_id, set()
+        period = rule_period(rules, now - date)
+        if period is None:
+            continue
+        if period is False:
+            expired.append(key)
+            continue
+        bucket = (period, (date - EPOCH) // period)
+        if bucket in seen:
+            expired.append(key)
+        else:
+            seen.add(bucket)
+    return expired
+
+
+def key_condition(columns, keys):
+    if len(columns) == 1:
+        return columns[0].in_([key for key, in keys])
+    return tuple_(*columns).in_(keys)
+
+
+def table_size(session, table):
+    """Bytes used by the table and its indexes, None if the database does not tell."""
+    if session.get_bind().dialect.name != 'mysql':
+        return None
+    return session.execute('SELECT data_length + index_length FROM information_schema.tables '
+                           'WHERE table_schema = DATABASE() AND table_name = :table', {'table': table}).scalar()
+
+
+class Archive(object):
+    """Gzipped JSON lines file the dropped rows of a table are appended to."""
+
+    def __init__(self, table, directory=RETENTION_ARCHIVE_DIR):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, '{}-{}.jsonl.gz'.format(table, datetime.now().strftime('%Y%m%d%H%M%S')))
+
+    def write(self, rows):
+        with gzip.open(self.path, 'ab') as archive:
+            for row in rows:
+                archive.write(json.dumps(dict(row), ensure_ascii=False, default=str).encode('utf-8') + b'\n')
+            archive.flush()
+            os.fsync(archive.fileobj.fileno())
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+
+def compact_table(session, name, rules, archive=None, after_user=None, now=None):
+    """Archives and deletes the rows of the history table `name` that `rules` do not keep,
+    only counts them without `archive`.
+
+    Works through the users in order, RETENTION_USERS at a time, and deletes at most
+    RETENTION_BATCH rows per transaction; every dropped row is written to the archive
+    before it is deleted. Yields (last user id, rows dropped) after every batch of users,
+    so an interrupted run can be continued with `after_user`.
+    """
+    table = HISTORY_MODELS[name].__table__
+    key_columns = list(table.primary_key.columns)
+    now = now or datetime.now()
+    users = select([table.c.user_id]).distinct().order_by(table.c.user_id)
+    if after_user is not None:
+        users = users.where(table.c.user_id > after_user)
+    users = [user_id for user_id, in session.execute(users)]
+    for start in range(0, len(users), RETENTION_USERS):
+        batch = users[start:start + RETENTION_USERS]
+        rows = session.execute(select(key_columns + [table.c.user_id, table.c.date])
+                               .where(table.c.user_id.in_(batch))
+                               .order_by(table.c.user_id, table.c.date.desc()))
+        rows = [(tuple(row[:len(key_columns)]), row[-2], row[-1]) for row in rows]
+        expired = expired_rows(rows, rules, now)
+        if archive is not None:
+            for chunk in range(0, len(expired), RETENTION_BATCH):
+                keys = expired[chunk:chunk + RETENTION_BATCH]
+                condition = key_condition(key_columns, keys)
+                archive.write(session.execute(table.select().where(condition)))
+                session.execute(table.delete().where(condition))
+                session.commit()
+        yield batch[-1], len(expired)
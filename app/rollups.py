@@ -0,0 +1,115 @@
+from sqlalchemy import select, func, tuple_
+
+from config import CASTLE
+from app.types import (LATEST_MODELS, Report, SquadMember, BattleRollup, BuildReport, BuildBucket, BuildContribution,
+                       Equip, EquipChange, BUILD_BUCKET_HOURS, battle_time, bucket_start, equip_change_rows)
+
+REBUILD_CHUNK = 1000
+BACKFILL_USERS = 200
+
+
+def rebuild_latest_snapshots(session):
+    """Refills the latest tables from the full history, yields (table name, rows) per table."""
+    for model, latest in LATEST_MODELS.items():
+        history = model.__table__
+        columns = [column.name for column in latest.__table__.columns]
+        newest = select([history.c.user_id, func.max(history.c.date)]).group_by(history.c.user_id)
+        rows = select([history.c[name] for name in columns])\
+            .where(tuple_(history.c.user_id, history.c.date).in_(newest))
+        session.query(latest).delete(synchronize_session=False)
+        session.execute(latest.__table__.insert().from_select(columns, rows))
+        session.commit()
+        yield latest.__tablename__, session.query(latest).count()
+
+
+def rebuild_battle_rollups(session):
+    """Recomputes battle_rollups from the reports table, returns the number of rows written.
+
+    Reports are counted by the current squad of their authors.
+    """
+    squads = dict(session.query(SquadMember.user_id, SquadMember.squad_id))
+    totals = {}
+    battle, seen = None, set()
+    reports = session.query(Report.user_id, Report.date, Report.earned_exp, Report.earned_gold, Report.earned_stock)
+    if CASTLE:
+        reports = reports.filter(Report.castle == CASTLE)
+    for user_id, date, earned_exp, earned_gold, earned_stock in reports.order_by(Report.date).yield_per(REBUILD_CHUNK):
+        if battle_time(date) != battle:
+            battle, seen = battle_time(date), set()
+        # Повторно пересланный репорт той же битвы не считается
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        for squad_id in [0, squads[user_id]] if squads.get(user_id) else [0]:
+            row = totals.setdefault((battle, squad_id), [0, 0, 0, 0])
+            row[0] += 1
+            row[1] += earned_exp or 0
+            row[2] += earned_gold or 0
+            row[3] += earned_stock or 0
+    rows = [{'battle': battle, 'squad_id': squad_id, 'participants': participants, 'earned_exp': earned_exp,
+             'earned_gold': earned_gold, 'earned_stock': earned_stock}
+            for (battle, squad_id), (participants, earned_exp, earned_gold, earned_stock) in totals.items()]
+    session.query(BattleRollup).delete(synchronize_session=False)
+    if rows:
+        session.execute(BattleRollup.__table__.insert(), rows)
+    session.commit()
+    return len(rows)
+
+
+def rebuild_build_rollups(session):
+    """Recomputes build_buckets and build_contributions from build_reports, returns the number of rows written."""
+    buckets = {}
+    contributions = {}
+    reports = session.query(BuildReport.user_id, BuildReport.date, BuildReport.building, BuildReport.progress_percent)
+    for user_id, date, building, progress in reports.order_by(BuildReport.date).yield_per(REBUILD_CHUNK):
+        if not building:
+            continue
+        building = building[:100]
+        for hours in BUILD_BUCKET_HOURS:
+            bucket = buckets.setdefault((building, hours, bucket_start(date, hours)), [0, None, None])
+            bucket[0] += 1
+            bucket[1] = progress
+            bucket[2] = date
+        contribution = contributions.setdefault((building, user_id), [0, None])
+        contribution[0] += 1
+        contribution[1] = date
+    session.query(BuildBucket).delete(synchronize_session=False)
+    session.query(BuildContribution).delete(synchronize_session=False)
+    bucket_rows = [{'building': building, 'hours': hours, 'start': start, 'reports': count, 'progress': progress,
+                    'last_date': last_date}
+                   for (building, hours, start), (count, progress, last_date) in buckets.items()]
+    contribution_rows = [{'building': building, 'user_id': user_id, 'reports': count, 'last_date': last_date}
+                         for (building, user_id), (count, last_date) in contributions.items()]
+    if bucket_rows:
+        session.execute(BuildBucket.__table__.insert(), bucket_rows)
+    if contribution_rows:
+        session.execute(BuildContribution.__table__.insert(), contribution_rows)
+    session.commit()
+    return len(bucket_rows) + len(contribution_rows)
+
+
+def backfill_equip_changes(session, after_user=None, batch_users=BACKFILL_USERS):
+    """Recomputes equip_changes of every user with an id above `after_user`, `batch_users` users per transaction.
+
+    Yields (last user id, rows written) after every committed batch, so an interrupted
+    backfill can be continued from the last printed user id.
+    """
+    users = session.query(Equip.user_id).distinct().order_by(Equip.user_id)
+    if after_user is not None:
+        users = users.filter(Equip.user_id > after_user)
+    users = [user_id for user_id, in users]
+    for start in range(0, len(users), batch_users):
+        batch = users[start:start + batch_users]
+        rows = []
+        previous_user, previous_text = None, None
+        snapshots = session.query(Equip.user_id, Equip.date, Equip.equip).filter(Equip.user_id.in_(batch)) \
+            .order_by(Equip.user_id, Equip.date)
+        for user_id, date, text in snapshots.yield_per(REBUILD_CHUNK):
+            if user_id == previous_user:
+                rows.extend(equip_change_rows(user_id, date, previous_text, text))
+            previous_user, previous_text = user_id, text
+        session.query(EquipChange).filter(EquipChange.user_id.in_(batch)).delete(synchronize_session=False)
+        if rows:
+            session.execute(EquipChange.__table__.insert(), rows)
+        session.commit()
+        yield batch[-1], len(rows)
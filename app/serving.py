@@ -0,0 +1,23 @@
+import config
+
+WEB_BIND = getattr(config, 'WEB_BIND', '0.0.0.0:5000')
+WEB_WORKERS = getattr(config, 'WEB_WORKERS', 4)
+WEB_THREADS = getattr(config, 'WEB_THREADS', 8)
+# Все соединения с базой, которые могут открыть все воркеры вместе
+DB_CONNECTION_BUDGET = getattr(config, 'DB_CONNECTION_BUDGET', 100)
+# Соединения процесса помимо потоков запросов: запись лога из LogSink
+BACKGROUND_CONNECTIONS = 1
+
+
+def pool_options(budget=DB_CONNECTION_BUDGET, workers=WEB_WORKERS, threads=WEB_THREADS):
+    """create_engine() pool settings of one worker process so that `workers` processes
+    never open more than `budget` connections together.
+
+    A thread holds at most one connection, so the pool keeps one per thread and one
+    for background writes; what is left of the share of the worker may overflow.
+    """
+    share = budget // workers
+    if share < 1:
+        raise ValueError('a budget of {} connections is too small for {} workers'.format(budget, workers))
+    pool_size = min(threads + BACKGROUND_CONNECTIONS, share)
+    return {'pool_size': pool_size, 'max_overflow': share - pool_size}
@@ -0,0 +1,48 @@
+import re
+from collections import Counter
+
+import config
+from app.cache import ParseCache
+
+# "Нитки (12)", "/a_101 Нитки (12)" или "Нитки x 12"
+STOCK_LINE = re.compile(r'^\s*(?:/\w+\s+)?(?P<item>[^\n()]+?)\s*(?:\((?P<count>\d+)\)|x\s*(?P<times>\d+))\s*$',
+                        re.MULTILINE)
+
+
+def parse_stock(text):
+    """Tuple of (item, count) pairs found in the stock text, in the order of the text."""
+    if not text:
+        return ()
+    return tuple((match.group('item'), int(match.group('count') or match.group('times')))
+                 for match in STOCK_LINE.finditer(text))
+
+
+# Разобранный сток по id строки Stock
+STOCK_CACHE = ParseCache(parse_stock, getattr(config, 'STOCK_CACHE_SIZE', 5000))
+
+
+class SquadStock(object):
+    """Resources of a squad summed over the newest stock of every member."""
+
+    def __init__(self):
+        self.totals = Counter()
+        # item -> [(user, count)]
+        self.holders = {}
+
+    def add(self, user, items):
+        for item, count in items:
+            self.totals[item] += count
+            self.holders.setdefault(item, []).append((user, count))
+
+    def resources(self):
+        """[(item, total, holders)] sorted by item name, holders with the most first."""
+        return [(item, total, sorted(self.holders[item], key=lambda holder: -holder[1]))
+                for item, total in sorted(self.totals.items())]
+
+
+def squad_stock(rows):
+    """SquadStock of (stock id, stock text, user) rows."""
+    stock = SquadStock()
+    for stock_id, text, user in rows:
+        stock.add(user, STOCK_CACHE.parse(stock_id, text))
+    return stock
@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime
+from datetime import datetime, timedelta
+from time import time
+from threading import Lock, RLock, Thread, Event
+from queue import Queue, Full, Empty
 from enum import Enum
+import atexit
 import logging
+import os
+import random
 
 from sqlalchemy import (
-    create_engine,
-    Column, Integer, DateTime, Boolean, ForeignKey, UnicodeText, BigInteger, Text
+    create_engine, event, select, and_, or_, func,
+    Column, Index, Integer, DateTime, Boolean, ForeignKey, Unicode, UnicodeText, BigInteger, Text
 )
 from sqlalchemy.dialects.mysql import DATETIME
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, scoped_session
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DisconnectionError, IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import sessionmaker, relationship, scoped_session, aliased, foreign, Session as OrmSession
 
+import config
 from config import DB
+from app.equip import equip_changes
 
 
 class AdminType(Enum):
@@ -22,16 +32,211 @@ class AdminType(Enum):
     NOT_ADMIN = 100
 
 
-ENGINE = create_engine(DB,
-                       echo=False,
-                       pool_size=200,
-                       max_overflow=50,
-                       isolation_level="READ UNCOMMITTED")
+# Настройки движка по умолчанию; init_engine() может их переопределить
+ENGINE_OPTIONS = {'pool_size': getattr(config, 'DB_POOL_SIZE', 200),
+                  'max_overflow': getattr(config, 'DB_MAX_OVERFLOW', 50),
+                  'pool_recycle': getattr(config, 'DB_POOL_RECYCLE', 3600),
+                  'isolation_level': 'READ UNCOMMITTED'}
+# Проверять соединение перед каждой выдачей из пула
+DB_PRE_PING = getattr(config, 'DB_PRE_PING', True)
+# Реплики только для чтения, на них уходят запросы страниц сайта
+DB_REPLICAS = getattr(config, 'DB_REPLICAS', [])
+# На сколько секунд последние снимки реплики могут отставать от основной базы
+REPLICA_MAX_LAG = getattr(config, 'REPLICA_MAX_LAG', 30)
+# Как часто (в секундах) сверять реплики с основной базой
+REPLICA_CHECK_INTERVAL = getattr(config, 'REPLICA_CHECK_INTERVAL', 5)
+# Сколько секунд ждать соединения с репликой, прежде чем считать её недоступной
+REPLICA_CONNECT_TIMEOUT = getattr(config, 'REPLICA_CONNECT_TIMEOUT', 2)
+_engine = None
+_engine_pid = None
+_engine_url = None
+_engine_options = {}
+_replicas = None
+_replica_urls = None
+_engine_lock = Lock()
+
+
+def init_engine(url=None, replicas=None, **options):
+    """Sets the database URL, replica URLs and create_engine() options of get_engine()
+    and get_replicas(); nothing is connected yet.
+
+    Engines created before in this process are disposed of, ones inherited through fork are dropped.
+    """
+    global _engine, _engine_url, _engine_options, _replicas, _replica_urls
+    with _engine_lock:
+        if _engine_pid == os.getpid():
+            if _engine is not None:
+                _engine.dispose()
+            if _replicas is not None:
+                _replicas.dispose()
+        _engine = None
+        _replicas = None
+        _engine_url = url
+        _replica_urls = replicas
+        _engine_options = options
+
+
+def build_engine(url, connect_timeout=None):
+    url = make_url(url)
+    options = dict(ENGINE_OPTIONS, **_engine_options)
+    if url.get_backend_name() == 'sqlite':
+        # У SQLite свой пул без этих настроек
+        options.pop('pool_size', None)
+        options.pop('max_overflow', None)
+    elif connect_timeout is not None:
+        options['connect_args'] = dict(options.get('connect_args', {}), connect_timeout=connect_timeout)
+    engine = create_engine(url, echo=False, **options)
+    guard_pool(engine, DB_PRE_PING)
+    return engine
+
+
+def get_engine():
+    """The primary engine, created on first use from init_engine() settings or from config.DB."""
+    global _engine, _engine_pid
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = build_engine(_engine_url or DB)
+                _engine_pid = os.getpid()
+    return _engine
+
+
+def get_replicas():
+    """ReplicaSet of the replicas from init_engine() or config.DB_REPLICAS, None without replicas."""
+    global _replicas, _engine_pid
+    urls = _replica_urls if _replica_urls is not None else DB_REPLICAS
+    if _replicas is None and urls:
+        with _engine_lock:
+            if _replicas is None:
+                _replicas = ReplicaSet([build_engine(url, REPLICA_CONNECT_TIMEOUT) for url in urls])
+                _engine_pid = os.getpid()
+    return _replicas
+
+
+def guard_pool(engine, pre_ping=True):
+    """Makes the pool of `engine` replace connections opened by another process (inherited
+    through fork) and, with `pre_ping`, connections the server has closed.
+    """
+    @event.listens_for(engine, 'connect')
+    def remember_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def check_connection(dbapi_connection, connection_record, connection_proxy):
+        pid = connection_record.info.get('pid')
+        if pid != os.getpid():
+            # Сокет принадлежит родителю: не закрываем его, а только забываем
+            connection_record.connection = connection_proxy.connection = None
+            raise DisconnectionError('connection was opened in process {}'.format(pid))
+        if pre_ping:
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            except engine.dialect.dbapi.Error:
+                raise DisconnectionError('connection was closed by the server')
+            finally:
+                cursor.close()
+
+
+def snapshot_dates(engine):
+    """Newest dates of the tables the bot writes most often, read from `engine`."""
+    newest = [select([func.max(model.date)]).as_scalar() for model in (Character, Equip, Report)]
+    with engine.connect() as connection:
+        return tuple(connection.execute(select(newest)).first())
+
+
+class ReplicaSet(object):
+    """Replica engines and which of them are close enough to the primary to read from.
+
+    Every `check_interval` seconds the newest snapshot dates of the primary and of
+    every replica are compared; a replica more than `max_lag` seconds behind, or
+    unreachable, is skipped until the next check finds it caught up.
+    """
+
+    def __init__(self, engines, max_lag=REPLICA_MAX_LAG, check_interval=REPLICA_CHECK_INTERVAL):
+        self.engines = engines
+        self.max_lag = timedelta(seconds=max_lag)
+        self.check_interval = check_interval
+        self.fresh = []
+        self._checked_at = 0
+        self._lock = Lock()
+
+    def choose(self):
+        """A fresh replica engine, None if every replica is behind.
+
+        One thread refreshes the list when it is due, the others keep using the previous one.
+        """
+        if time() - self._checked_at >= self.check_interval and self._lock.acquire(False):
+            try:
+                if time() - self._checked_at >= self.check_interval:
+                    self.fresh = self.check()
+                    self._checked_at = time()
+            finally:
+                self._lock.release()
+        fresh = self.fresh
+        return random.choice(fresh) if fresh else None
+
+    def check(self):
+        try:
+            primary = snapshot_dates(get_engine())
+        except SQLAlchemyError:
+            LOGGER.exception('Failed to read snapshot dates of the primary')
+            return []
+        fresh = []
+        for engine in self.engines:
+            try:
+                dates = snapshot_dates(engine)
+            except SQLAlchemyError:
+                LOGGER.exception('Replica %s is unavailable', engine.url)
+                continue
+            if all(newest is None or (date is not None and newest - date <= self.max_lag)
+                   for newest, date in zip(primary, dates)):
+                fresh.append(engine)
+            else:
+                LOGGER.warning('Replica %s is behind the primary', engine.url)
+        return fresh
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+class EngineSession(OrmSession):
+    """Session that connects through get_engine() unless bound explicitly.
+
+    Sessions with info['read_only'] read from one fresh replica, if there is one;
+    while info['writing'] is set, as it is during flushes, they use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.bind is not None:
+            return super(EngineSession, self).get_bind(mapper, clause)
+        if self.info.get('read_only') and not self.info.get('writing'):
+            if 'replica' not in self.info:
+                replicas = get_replicas()
+                self.info['replica'] = replicas.choose() if replicas is not None else None
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return get_engine()
+
+    def flush(self, objects=None):
+        writing = self.info.get('writing')
+        self.info['writing'] = True
+        try:
+            super(EngineSession, self).flush(objects)
+        finally:
+            self.info['writing'] = writing
+
 
 # FIX: имена констант?
 LOGGER = logging.getLogger('sqlalchemy.engine')
 Base = declarative_base()
-Session = scoped_session(sessionmaker(bind=ENGINE))
+Session = scoped_session(sessionmaker(class_=EngineSession))
+
+
+def create_schema(engine=None):
+    """Creates missing tables, see also `flask create-schema`."""
+    Base.metadata.create_all(engine or get_engine())
 
 
 class Group(Base):
@@ -59,22 +264,23 @@ class User(Base):
     last_name = Column(UnicodeText(250))
     date_added = Column(DateTime, default=datetime.now())
 
+    # Только последний снимок: связь отбирает строку с максимальной датой, а не всю историю
     character = relationship('Character',
-                             back_populates='user',
-                             order_by='Character.date.desc()',
-                             uselist=False)
+                             primaryjoin=lambda: newest_snapshot(Character),
+                             uselist=False,
+                             viewonly=True)
 
     orders_confirmed = relationship('OrderCleared', back_populates='user')
     member = relationship('SquadMember', back_populates='user', uselist=False)
     equip = relationship('Equip',
-                         back_populates='user',
-                         order_by='Equip.date.desc()',
-                         uselist=False)
+                         primaryjoin=lambda: newest_snapshot(Equip),
+                         uselist=False,
+                         viewonly=True)
 
     stock = relationship('Stock',
-                         back_populates='user',
-                         order_by='Stock.date.desc()',
-                         uselist=False)
+                         primaryjoin=lambda: newest_snapshot(Stock),
+                         uselist=False,
+                         viewonly=True)
 
     report = relationship('Report',
                           back_populates='user',
@@ -179,6 +385,9 @@ class OrderCleared(Base):
 
 class Stock(Base):
     __tablename__ = 'stock'
+    __table_args__ = (
+        Index('ix_stock_user_id_date', 'user_id', 'date'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey(User.id))
@@ -186,11 +395,15 @@ class Stock(Base):
     date = Column(DATETIME(fsp=6), default=datetime.now())
     stock_type = Column(Integer)
 
-    user = relationship('User', back_populates='stock')
+    user = relationship('User')
 
 
 class Character(Base):
     __tablename__ = 'characters'
+    __table_args__ = (
+        Index('ix_characters_castle', 'castle', mysql_length=20),
+        Index('ix_characters_date', 'date'),
+    )
 
     user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
     date = Column(DATETIME(fsp=6), primary_key=True)
@@ -208,11 +421,14 @@ class Character(Base):
     gold = Column(Integer, default=0)
     donateGold = Column(Integer, default=0)
 
-    user = relationship('User', back_populates='character')
+    user = relationship('User')
 
 
 class BuildReport(Base):
     __tablename__ = 'build_reports'
+    __table_args__ = (
+        Index('ix_build_reports_date', 'date'),
+    )
 
     user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
     date = Column(DATETIME(fsp=6), primary_key=True)
@@ -225,6 +441,9 @@ class BuildReport(Base):
 
 class Report(Base):
     __tablename__ = 'reports'
+    __table_args__ = (
+        Index('ix_reports_date', 'date'),
+    )
 
     user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
     date = Column(DATETIME(fsp=6), primary_key=True)
@@ -256,7 +475,7 @@ class Squad(Base):
 class SquadMember(Base):
     __tablename__ = 'squad_members'
 
-    squad_id = Column(BigInteger, ForeignKey(Squad.chat_id))
+    squad_id = Column(BigInteger, ForeignKey(Squad.chat_id), index=True)
     user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
     approved = Column(Boolean, default=False)
 
@@ -266,13 +485,111 @@ class SquadMember(Base):
 
 class Equip(Base):
     __tablename__ = 'equip'
+    __table_args__ = (
+        Index('ix_equip_date', 'date'),
+    )
 
     user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
     date = Column(DATETIME(fsp=6), primary_key=True)
 
     equip = Column(UnicodeText(250))
 
-    user = relationship('User', back_populates='equip')
+    user = relationship('User')
+
+
+class CharacterLatest(Base):
+    """Newest Character snapshot of every user, kept up to date on insert."""
+    __tablename__ = 'characters_latest'
+    __table_args__ = (
+        Index('ix_characters_latest_castle', 'castle', mysql_length=20),
+        Index('ix_characters_latest_level', 'level'),
+        Index('ix_characters_latest_date', 'date'),
+    )
+
+    user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
+    date = Column(DATETIME(fsp=6))
+    name = Column(UnicodeText(250))
+    prof = Column(UnicodeText(250))
+    pet = Column(UnicodeText(250), nullable=True, default=None)
+    petLevel = Column(Integer, default=0)
+    maxStamina = Column(Integer, default=5)
+    level = Column(Integer)
+    attack = Column(Integer)
+    defence = Column(Integer)
+    exp = Column(Integer)
+    needExp = Column(Integer, default=0)
+    castle = Column(UnicodeText(100))
+    gold = Column(Integer, default=0)
+    donateGold = Column(Integer, default=0)
+
+
+class EquipLatest(Base):
+    """Newest Equip snapshot of every user, kept up to date on insert."""
+    __tablename__ = 'equip_latest'
+    __table_args__ = (
+        Index('ix_equip_latest_date', 'date'),
+    )
+
+    user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
+    date = Column(DATETIME(fsp=6))
+
+    equip = Column(UnicodeText(250))
+
+
+LATEST_MODELS = {Character: CharacterLatest, Equip: EquipLatest}
+# Вести characters_latest/equip_latest при записи снимков и читать последние снимки из них.
+# Выключенные таблицы не обновляются; после включения их заполняет `flask rebuild-latest`
+LATEST_SNAPSHOTS = getattr(config, 'LATEST_SNAPSHOTS', False)
+
+
+class BuildBucket(Base):
+    """Construction reports of a building per hour (hours=1) and per day (hours=24)."""
+    __tablename__ = 'build_buckets'
+
+    building = Column(Unicode(100), primary_key=True)
+    hours = Column(Integer, primary_key=True)
+    start = Column(DATETIME(fsp=6), primary_key=True)
+    reports = Column(Integer, default=0)
+    progress = Column(Integer)
+    last_date = Column(DATETIME(fsp=6))
+
+
+class BuildContribution(Base):
+    __tablename__ = 'build_contributions'
+
+    building = Column(Unicode(100), primary_key=True)
+    user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
+    reports = Column(Integer, default=0)
+    last_date = Column(DATETIME(fsp=6))
+
+
+class EquipChange(Base):
+    """Slot of EQUIP_PARTS that changed between two consecutive Equip snapshots of a user."""
+    __tablename__ = 'equip_changes'
+    __table_args__ = (
+        Index('ix_equip_changes_date', 'date'),
+    )
+
+    user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
+    date = Column(DATETIME(fsp=6), primary_key=True)
+    slot = Column(Unicode(20), primary_key=True)
+    old_item = Column(Unicode(250), nullable=True)
+    new_item = Column(Unicode(250), nullable=True)
+    upgrade = Column(Boolean, default=False)
+
+    user = relationship('User')
+
+
+class BattleRollup(Base):
+    """Report totals of a battle for the castle (squad_id 0) and for every squad."""
+    __tablename__ = 'battle_rollups'
+
+    battle = Column(DATETIME(fsp=6), primary_key=True)
+    squad_id = Column(BigInteger, primary_key=True, default=0)
+    participants = Column(Integer, default=0)
+    earned_exp = Column(BigInteger, default=0)
+    earned_gold = Column(BigInteger, default=0)
+    earned_stock = Column(BigInteger, default=0)
 
 
 class LocalTrigger(Base):
@@ -312,37 +629,292 @@ class Auth(Base):
     user_id = Column(BigInteger, ForeignKey(User.id), primary_key=True)
 
 
+class PermissionResolver(object):
+    """Admin grants of users, loaded once and kept for `ttl` seconds.
+
+    Changes of the admins table made through the ORM drop the cached grants
+    at once, other changes are picked up when the TTL runs out.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._grants = {}
+
+    def grants(self, session, user_id):
+        """(admin_type, admin_group, bot is in the group) for every admin row of the user."""
+        entry = self._grants.get(user_id)
+        if entry is not None and entry[0] > time():
+            return entry[1]
+        rows = session.query(Admin.admin_type, Admin.admin_group, Group.bot_in_group) \
+            .outerjoin(Group, Group.id == Admin.admin_group) \
+            .filter(Admin.user_id == user_id).all()
+        grants = tuple((admin_type, admin_group, bool(bot_in_group)) for admin_type, admin_group, bot_in_group in rows)
+        self._grants[user_id] = (time() + self.ttl, grants)
+        return grants
+
+    def is_admin(self, session, user_id, chat_id, adm_type):
+        """May the user act as an admin of `adm_type` or higher in the chat."""
+        if adm_type == AdminType.NOT_ADMIN:
+            return True
+        for admin_type, admin_group, bot_in_group in self.grants(session, user_id):
+            if admin_type <= adm_type.value and (admin_group in [0, chat_id] or chat_id == user_id):
+                if admin_group == 0 or bot_in_group:
+                    return True
+        return False
+
+    def can_view_squad(self, session, user_id, squad_id):
+        for admin_type, admin_group, bot_in_group in self.grants(session, user_id):
+            if admin_type in (AdminType.SUPER.value, AdminType.FULL.value) or admin_group == squad_id:
+                return True
+        return False
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self._grants.clear()
+        else:
+            self._grants.pop(user_id, None)
+
+
+PERMISSIONS = PermissionResolver(getattr(config, 'PERMISSIONS_TTL', 60))
+
+
+@event.listens_for(Admin, 'after_insert')
+@event.listens_for(Admin, 'after_update')
+@event.listens_for(Admin, 'after_delete')
+def admin_changed(mapper, connection, target):
+    PERMISSIONS.invalidate(target.user_id)
+
+
+@event.listens_for(Group, 'after_update')
+def group_changed(mapper, connection, target):
+    PERMISSIONS.invalidate()
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def bulk_changed(context):
+    PERMISSIONS.invalidate()
+    BANS.reset()
+
+
 def check_admin(update, session, adm_type):
-    allowed = False
-    if adm_type == AdminType.NOT_ADMIN:
-        allowed = True
-    else:
-        admins = session.query(Admin).filter_by(user_id=update.message.from_user.id).all()
-        for adm in admins:
-            if adm is not None and adm.admin_type <= adm_type.value and \
-                    (adm.admin_group in [0, update.message.chat.id] or
-                     update.message.chat.id == update.message.from_user.id):
-                if adm.admin_group != 0:
-                    group = session.query(Group).filter_by(id=adm.admin_group).first()
-                    if group and group.bot_in_group:
-                        allowed = True
-                        break
-                else:
-                    allowed = True
-                    break
-    return allowed
+    return PERMISSIONS.is_admin(session, update.message.from_user.id, update.message.chat.id, adm_type)
+
+
+class BanRegistry(object):
+    """Bans kept in memory as user_id -> to_date.
+
+    Every `refresh_interval` seconds bans added since the last refresh are
+    fetched, every `full_reload_every`-th refresh reloads the whole table to
+    catch edited and removed rows. Expired bans are dropped without a query.
+    """
+
+    def __init__(self, refresh_interval=60, full_reload_every=10):
+        self.refresh_interval = refresh_interval
+        self.full_reload_every = full_reload_every
+        self._bans = {}
+        self._refreshed_at = 0
+        self._refreshes = 0
+        self._newest = None
+        # Повторный вход: автофлаш запроса банов может записать бан и вызвать add()
+        self._lock = RLock()
+
+    def refresh(self, session, full=False):
+        with self._lock:
+            self._refresh(session, full)
+
+    def _refresh(self, session, full=False):
+        full = full or self._newest is None or self._refreshes % self.full_reload_every == 0
+        query = session.query(Ban.user_id, Ban.from_date, Ban.to_date) \
+            .filter(or_(Ban.to_date.is_(None), Ban.to_date >= datetime.now()))
+        if not full:
+            query = query.filter(Ban.from_date > self._newest)
+        rows = query.all()
+        bans = {} if full else dict(self._bans)
+        for user_id, from_date, to_date in rows:
+            bans[user_id] = to_date
+            if from_date and (self._newest is None or from_date > self._newest):
+                self._newest = from_date
+        self._bans = bans
+        if self._newest is None:
+            self._newest = datetime.min
+        self._refreshes += 1
+        self._refreshed_at = time()
+
+    def is_banned(self, session, user_id):
+        if time() - self._refreshed_at > self.refresh_interval:
+            # Пока один поток подгружает баны, остальные проверяют по уже загруженным
+            if self._lock.acquire(not self._refreshed_at):
+                try:
+                    if time() - self._refreshed_at > self.refresh_interval:
+                        self._refresh(session)
+                finally:
+                    self._lock.release()
+        to_date = self._bans.get(user_id, False)
+        if to_date is False:
+            return False
+        # Бан без даты окончания бессрочный; истёкшие баны уйдут при полной перезагрузке
+        return to_date is None or to_date >= datetime.now()
+
+    def add(self, ban):
+        with self._lock:
+            self._bans[ban.user_id] = ban.to_date
+
+    def remove(self, user_id):
+        with self._lock:
+            self._bans.pop(user_id, None)
+
+    def reset(self):
+        self._refreshed_at = 0
+        self._newest = None
+
+
+BANS = BanRegistry(getattr(config, 'BANS_REFRESH_INTERVAL', 60))
+
+
+@event.listens_for(Ban, 'after_insert')
+@event.listens_for(Ban, 'after_update')
+def ban_written(mapper, connection, target):
+    BANS.add(target)
+
+
+@event.listens_for(Ban, 'after_delete')
+def ban_deleted(mapper, connection, target):
+    BANS.remove(target.user_id)
 
 
 def check_ban(update, session):
-    ban = session.query(Ban).filter_by(user_id=update.message.from_user.id
-                                       if update.message else update.callback_query.from_user.id).first()
-    if ban is None or ban.to_date < datetime.now():
+    """True if the author of the update is not banned."""
+    user_id = update.message.from_user.id if update.message else update.callback_query.from_user.id
+    return not BANS.is_banned(session, user_id)
+
+
+class LogSink(object):
+    """Writes Log rows from a background thread as multi-row inserts.
+
+    Rows are flushed when `batch_size` of them are queued or `flush_interval`
+    seconds have passed. At most `max_queue` rows wait in memory: with the
+    'drop' policy further rows are dropped and counted, with 'block' the
+    caller waits for free space. On exit the thread writes the rows it has
+    taken and everything still queued is flushed.
+    """
+
+    _WAKE = object()
+
+    def __init__(self, engine=None, batch_size=100, flush_interval=1.0, max_queue=10000, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError('unknown log overflow policy {!r}'.format(policy))
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.queue = Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.written = 0
+        self._reported_dropped = 0
+        self._pid = None
+        self._thread = None
+        self._stopped = Event()
+        self._start_lock = Lock()
+        self._write_lock = Lock()
+        atexit.register(self.stop)
+
+    def put(self, row):
+        if self._pid != os.getpid():
+            self._start()
+        if self.policy == 'block':
+            self.queue.put(row)
+            return
+        try:
+            self.queue.put_nowait(row)
+        except Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Writes everything queued so far in the calling thread."""
+        while self._write(self._take(block=False)):
+            pass
+
+    def stop(self):
+        """Stops the thread after it has written the rows it took, then flushes the rest."""
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            try:
+                # Будит поток, ждущий строки; при полной очереди он и так не ждёт
+                self.queue.put_nowait(self._WAKE)
+            except Full:
+                pass
+            self._thread.join()
+            self._thread, self._pid = None, None
+        self.flush()
+        self._report_dropped()
+
+    def _start(self):
+        with self._start_lock:
+            # После fork поток родителя в дочернем процессе не существует; в процессе поток должен быть один
+            if self._pid == os.getpid():
+                return
+            self._stopped.clear()
+            self._thread = Thread(target=self._run, name='log-sink')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._write(self._take(block=True))
+            except Exception:
+                LOGGER.exception('Failed to write log rows')
+            self._report_dropped()
+
+    def _take(self, block):
+        rows = []
+        deadline = time() + self.flush_interval
+        while len(rows) < self.batch_size:
+            try:
+                if block:
+                    row = self.queue.get(timeout=max(deadline - time(), 0.001))
+                else:
+                    row = self.queue.get_nowait()
+            except Empty:
+                break
+            if row is self._WAKE:
+                break
+            rows.append(row)
+        return rows
+
+    def _write(self, rows):
+        if not rows:
+            return False
+        with self._write_lock:
+            with (self.engine or get_engine()).begin() as connection:
+                connection.execute(Log.__table__.insert(), rows)
+        self.written += len(rows)
         return True
-    else:
-        return False
+
+    def _report_dropped(self):
+        dropped = self.dropped
+        if dropped > self._reported_dropped:
+            LOGGER.warning('Log queue is full, dropped %d rows (%d in total)', dropped - self._reported_dropped,
+                           dropped)
+            self._reported_dropped = dropped
+
+
+# Буферизованная запись лога; None - каждая запись пишется и коммитится сразу
+LOG_SINK = None
+if getattr(config, 'LOG_BUFFERED', False):
+    LOG_SINK = LogSink(batch_size=getattr(config, 'LOG_BATCH_SIZE', 100),
+                       flush_interval=getattr(config, 'LOG_FLUSH_INTERVAL', 1.0),
+                       max_queue=getattr(config, 'LOG_MAX_QUEUE', 10000),
+                       policy=getattr(config, 'LOG_OVERFLOW_POLICY', 'drop'))
 
 
 def log(session, user_id, chat_id, func_name, args):
+    if LOG_SINK is not None:
+        LOG_SINK.put({'date': datetime.now(), 'user_id': user_id, 'chat_id': chat_id,
+                      'func_name': func_name, 'args': args})
+        return
     log_item = Log()
     log_item.date = datetime.now()
     log_item.user_id = user_id
@@ -353,4 +925,143 @@ def log(session, user_id, chat_id, func_name, args):
     session.commit()
 
 
-Base.metadata.create_all(ENGINE)
+# Часы битв по времени, в котором бот записывает даты
+BATTLE_HOURS = sorted(getattr(config, 'BATTLE_HOURS', [1, 9, 17]))
+
+
+def battle_time(date):
+    """Start of the battle a report written at `date` belongs to."""
+    day = date.replace(minute=0, second=0, microsecond=0)
+    for hour in reversed(BATTLE_HOURS):
+        if date.hour >= hour:
+            return day.replace(hour=hour)
+    return day.replace(hour=BATTLE_HOURS[-1]) - timedelta(days=1)
+
+
+def newest_snapshot(model):
+    """Join condition of a User relationship that loads only the newest row of `model`."""
+    newest = aliased(model)
+    newest_date = select([func.max(newest.date)]).where(newest.user_id == model.user_id).as_scalar()
+    return and_(User.id == foreign(model.user_id), model.date == newest_date)
+
+
+def insert_row(connection, table, row):
+    """Inserts `row` in a savepoint; False if another transaction has inserted the same key first."""
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert().values(row))
+    except IntegrityError:
+        savepoint.rollback()
+        return False
+    savepoint.commit()
+    return True
+
+
+def update_latest(connection, latest, target):
+    """Copies a freshly inserted snapshot into its latest table unless a newer one is already there."""
+    table = latest.__table__
+    values = {column.name: getattr(target, column.name) for column in table.columns}
+    update = table.update().where(and_(table.c.user_id == target.user_id, table.c.date <= target.date)).values(values)
+    result = connection.execute(update)
+    if not result.rowcount:
+        exists = connection.execute(select([table.c.user_id]).where(table.c.user_id == target.user_id)).first()
+        if exists is None and not insert_row(connection, table, values):
+            # Параллельный снимок того же игрока вставлен первым: оставляем более новый
+            connection.execute(update)
+
+
+@event.listens_for(Character, 'after_insert')
+def character_inserted(mapper, connection, target):
+    if LATEST_SNAPSHOTS:
+        update_latest(connection, CharacterLatest, target)
+
+
+def equip_change_rows(user_id, date, old_text, new_text):
+    return [{'user_id': user_id, 'date': date, 'slot': slot, 'old_item': old_item, 'new_item': new_item,
+             'upgrade': upgrade}
+            for slot, old_item, new_item, upgrade in equip_changes(old_text, new_text)]
+
+
+@event.listens_for(Equip, 'after_insert')
+def equip_inserted(mapper, connection, target):
+    previous = connection.execute(select([Equip.equip])
+                                  .where(and_(Equip.user_id == target.user_id, Equip.date < target.date))
+                                  .order_by(Equip.date.desc()).limit(1)).first()
+    if LATEST_SNAPSHOTS:
+        update_latest(connection, EquipLatest, target)
+    if previous is not None:
+        rows = equip_change_rows(target.user_id, target.date, previous[0], target.equip)
+        if rows:
+            connection.execute(EquipChange.__table__.insert(), rows)
+
+
+def add_to_rollup(connection, model, key, values, latest=None, date=None):
+    """Adds `values` to the counters of the rollup row with primary key `key`, creating it if needed.
+
+    `latest` values are stored only if `date` is not older than the last_date of the row.
+    If another transaction creates the row between the UPDATE and the INSERT, the values are added to its row.
+    """
+    table = model.__table__
+    condition = and_(*[table.c[name] == value for name, value in key.items()])
+    counters = table.update().where(condition).values({name: table.c[name] + value for name, value in values.items()})
+    if not connection.execute(counters).rowcount:
+        row = dict(key)
+        row.update(values)
+        if latest is not None:
+            row.update(latest, last_date=date)
+        if insert_row(connection, table, row):
+            return
+        # Строку между UPDATE и INSERT создал параллельный поток: прибавляем к ней
+        connection.execute(counters)
+    if latest is not None:
+        latest = dict(latest, last_date=date)
+        connection.execute(table.update()
+                           .where(and_(condition, or_(table.c.last_date.is_(None), table.c.last_date <= date)))
+                           .values(latest))
+
+
+def report_squads(connection, user_id):
+    """Rollup rows a report of the user is counted in: the castle and the squad of the user."""
+    squad_id = connection.execute(select([SquadMember.squad_id]).where(SquadMember.user_id == user_id)).scalar()
+    return [0, squad_id] if squad_id else [0]
+
+
+@event.listens_for(Report, 'after_insert')
+def report_inserted(mapper, connection, target):
+    if getattr(config, 'CASTLE', None) and target.castle != config.CASTLE:
+        return
+    battle = battle_time(target.date)
+    reports = Report.__table__
+    # Повторно пересланный репорт той же битвы не считается
+    duplicate = connection.execute(select([reports.c.user_id])
+                                   .where(and_(reports.c.user_id == target.user_id,
+                                               reports.c.date >= battle, reports.c.date < target.date))
+                                   .limit(1)).first()
+    if duplicate is not None:
+        return
+    values = {'participants': 1, 'earned_exp': target.earned_exp or 0, 'earned_gold': target.earned_gold or 0,
+              'earned_stock': target.earned_stock or 0}
+    for squad_id in report_squads(connection, target.user_id):
+        add_to_rollup(connection, BattleRollup, {'battle': battle, 'squad_id': squad_id}, values)
+
+
+# Размеры корзин статистики стройки в часах
+BUILD_BUCKET_HOURS = [1, 24]
+
+
+def bucket_start(date, hours):
+    return date.replace(hour=date.hour - date.hour % hours, minute=0, second=0, microsecond=0)
+
+
+@event.listens_for(BuildReport, 'after_insert')
+def build_report_inserted(mapper, connection, target):
+    if not target.building:
+        return
+    building = target.building[:100]
+    for hours in BUILD_BUCKET_HOURS:
+        add_to_rollup(connection, BuildBucket,
+                      {'building': building, 'hours': hours, 'start': bucket_start(target.date, hours)},
+                      {'reports': 1}, latest={'progress': target.progress_percent}, date=target.date)
+    add_to_rollup(connection, BuildContribution, {'building': building, 'user_id': target.user_id},
+                  {'reports': 1}, latest={}, date=target.date)
+
@@ -1,27 +1,92 @@
+import json
+
 import flask
 from flask import render_template, session as flask_session
-from sqlalchemy import func, tuple_
 from sqlalchemy.exc import SQLAlchemyError
 
-from app import app
 from functools import wraps
-from flask import request, Response
+from flask import Blueprint, current_app, request, Response, stream_with_context
 
+import config
+from app.cache import ResponseCache, MemoryCache
+from app.charts import EPOCH, chart_points, timelines
 from app.constants import *
-from config import AUTH_LOGIN, AUTH_PASS, CASTLE, APP_SECRET_KEY
+from app.equip import get_parsed_equip, EQUIP_CACHE
+from app.leaderboards import LEADERBOARDS
+from app.stock import STOCK_CACHE, squad_stock
+from app.metrics import COLLECTORS, render_metrics, render_value
+from app.pages import render_static_pages
+from app.queries import (users_query, users_cursor, users_count, squads_query, squad_members_query, snapshot_watermark,
+                         battle_rollups, squad_size, player_reports, build_progress, build_series,
+                         build_contributors, build_squad_contributions, squad_stock_query,
+                         player_history, with_latest_snapshots, squad_equip_changes)
+from config import AUTH_LOGIN, AUTH_PASS
 from app.types import *
 
 from datetime import datetime, timedelta
 
 
-app.secret_key = APP_SECRET_KEY
-
-
-@app.before_request
+blueprint = Blueprint('views', __name__)
+USERS_PAGE_SIZE = getattr(config, 'USERS_PAGE_SIZE', 100)
+USERS_STREAM_CHUNK = 100
+TOP_SIZE = getattr(config, 'TOP_SIZE', 10)
+REPORTS_BATTLES = getattr(config, 'REPORTS_BATTLES', 20)
+BUILD_HOURS_SHOWN = getattr(config, 'BUILD_HOURS_SHOWN', 48)
+BUILD_DAYS_SHOWN = getattr(config, 'BUILD_DAYS_SHOWN', 30)
+PLAYER_CHART_POINTS = getattr(config, 'PLAYER_CHART_POINTS', 200)
+# Страницы, которые пишут в базу или читают только что записанное ботом: всегда основная база
+WRITE_VIEWS = {'views.index'}
+# Справочные страницы без данных из базы: рендерятся один раз и не трогают сессию пользователя
+STATIC_VIEWS = {'views.birja': 'birja.html', 'views.wrap': 'wrap.html'}
+STATIC_PAGES = {}
+RESPONSE_CACHE = ResponseCache(getattr(config, 'RESPONSE_CACHE_BACKEND', None),
+                               timeout=getattr(config, 'RESPONSE_CACHE_TTL', 60))
+
+
+def cache_metrics():
+    lines = render_value('castlestats_equip_cache_hits_total', 'counter', 'Parsed equip cache hits.', EQUIP_CACHE.hits)
+    lines += render_value('castlestats_equip_cache_misses_total', 'counter', 'Parsed equip cache misses.',
+                          EQUIP_CACHE.misses)
+    lines += render_value('castlestats_equip_cache_size', 'gauge', 'Parsed equip rows in cache.', len(EQUIP_CACHE))
+    lines += render_value('castlestats_stock_cache_hits_total', 'counter', 'Parsed stock cache hits.', STOCK_CACHE.hits)
+    lines += render_value('castlestats_stock_cache_misses_total', 'counter', 'Parsed stock cache misses.',
+                          STOCK_CACHE.misses)
+    if LOG_SINK is not None:
+        lines += render_value('castlestats_log_rows_written_total', 'counter', 'Buffered log rows written.',
+                              LOG_SINK.written)
+        lines += render_value('castlestats_log_rows_dropped_total', 'counter', 'Log rows dropped on a full queue.',
+                              LOG_SINK.dropped)
+    backend = RESPONSE_CACHE.backend
+    if isinstance(backend, MemoryCache):
+        lines += render_value('castlestats_response_cache_hits_total', 'counter', 'Response cache hits.', backend.hits)
+        lines += render_value('castlestats_response_cache_misses_total', 'counter', 'Response cache misses.',
+                              backend.misses)
+    return lines
+
+
+COLLECTORS.append(cache_metrics)
+
+
+@blueprint.record_once
+def render_pages(state):
+    STATIC_PAGES.update(render_static_pages(state.app, STATIC_VIEWS.values()))
+
+
+@blueprint.before_app_request
 def function_session():
+    if request.endpoint in STATIC_VIEWS:
+        return
     flask_session.modified = True
     flask_session.permanent = True
-    app.permanent_session_lifetime = timedelta(minutes=5)
+    current_app.permanent_session_lifetime = timedelta(minutes=5)
+
+
+@blueprint.before_app_request
+def route_reads():
+    """Lets the database session of the request read from a replica unless the view writes."""
+    info = Session().info
+    info['read_only'] = request.endpoint not in WRITE_VIEWS
+    info.pop('replica', None)
 
 
 def check_auth(username, password):
@@ -60,12 +125,84 @@ def requires_auth(func):
     return wrapper
 
 
-@app.route('/', methods=['GET'])
+def stream_template(template_name, **context):
+    """Renders a template piece by piece, so rows are sent while they are fetched."""
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(USERS_STREAM_CHUNK)
+    return stream
+
+
+def parse_cursor(value):
+    """Keyset cursor '<level>_<user_id>' of the /users pages."""
+    if not value:
+        return None
+    level, user_id = value.split('_')
+    return int(level), int(user_id)
+
+
+def user_scope():
+    return 'user'
+
+
+def admin_scope():
+    """Squads the session user may see: 'all' or the list of admin groups."""
+    grants = PERMISSIONS.grants(Session(), flask_session['user_id'])
+    if any(admin_type in (AdminType.SUPER.value, AdminType.FULL.value) for admin_type, group, active in grants):
+        return 'all'
+    return ','.join(sorted(str(group) for admin_type, group, active in grants))
+
+
+def cached_view(scope=user_scope, watermark=None):
+    """Caches the rendered page by route arguments and permission scope of the caller.
+
+    `watermark` returns a value that changes together with the data behind the page,
+    without it the page lives for RESPONSE_CACHE_TTL seconds.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                mark = watermark() if watermark else None
+                key = '{}|{}'.format(request.full_path, scope())
+            except SQLAlchemyError:
+                Session.rollback()
+                return view(*args, **kwargs)
+            cached = RESPONSE_CACHE.get(key, mark)
+            if cached is not None:
+                body, mimetype = cached
+                return Response(body, mimetype=mimetype)
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                RESPONSE_CACHE.set(key, (response.get_data(), response.mimetype), mark)
+            return response
+        return wrapper
+    return decorator
+
+
+def characters_watermark():
+    return snapshot_watermark(Session(), Character)
+
+
+def squad_watermark():
+    return snapshot_watermark(Session(), Character, Equip)
+
+
+def player_watermark():
+    user_id = request.view_args['id']
+    return Session().query(func.max(Character.date)).filter(Character.user_id == user_id).scalar()
+
+
+def stock_watermark():
+    return snapshot_watermark(Session(), Stock)
+
+
+@blueprint.route('/', methods=['GET'])
 def index():
     try:
         session = Session()
         if 'token' in request.args:
-            token = request.args.getlist('token')
+            token = request.args.get('token')
             auth = session.query(Auth).filter(Auth.id == token).first()
             if auth:
                 session.delete(auth)
@@ -81,123 +218,116 @@ def index():
         return flask.Response(status=400)
 
 
-@app.route('/403')
+@blueprint.route('/403')
 def not_authorized():
     return render_template('403.html')
 
 
-@app.route('/robots.txt')
+@blueprint.route('/metrics')
+@requires_bauth
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@blueprint.route('/robots.txt')
 def robots():
     return render_template('robots.txt')
 
 
 def get_squads():
     try:
-        all_squads = Session().query(Squad).join(SquadMember, SquadMember.squad_id == Squad.chat_id).all()
-        squads = []
-        for squad in all_squads:
-            squads.append(squad)
-        return squads
+        return squads_query(Session()).all()
     except SQLAlchemyError:
         Session.rollback()
         return flask.Response(status=400)
 
 
-@app.route('/users')
+@blueprint.route('/users')
 @requires_auth
 @requires_bauth
+@cached_view(watermark=characters_watermark)
 def get_usernames():
     try:
         session = Session()
-        sub_query = session.query(Character.user_id, func.max(Character.date)).group_by(Character.user_id).subquery()
-        characters = session.query(Character, User).filter(tuple_(Character.user_id, Character.date)
-                                                           .in_(sub_query))\
-            .join(User, User.id == Character.user_id)
-
-        if CASTLE:
-            characters = characters.filter(Character.castle == CASTLE)
-        characters = characters.all()
-        return render_template('users.html', characters=characters)
+        total = users_count(session)
+        if request.args.get('all'):
+            characters = users_query(session).yield_per(USERS_STREAM_CHUNK)
+            return Response(stream_with_context(stream_template('users.html', characters=characters, total=total)))
+        try:
+            after = parse_cursor(request.args.get('after'))
+        except ValueError:
+            return flask.Response(status=400)
+        characters = users_query(session, after).limit(USERS_PAGE_SIZE).all()
+        next_page = None
+        if len(characters) == USERS_PAGE_SIZE:
+            next_page = '{}_{}'.format(*users_cursor(characters[-1][0]))
+        return render_template('users.html', characters=characters, total=total, next_page=next_page)
     except SQLAlchemyError:
         Session.rollback()
         return flask.Response(status=400)
 
 
-@app.route('/player/<int:id>', methods=['GET'])
+@blueprint.app_template_filter('timestamp_date')
+def timestamp_date(value):
+    return (EPOCH + timedelta(seconds=value)).strftime('%d.%m.%Y')
+
+
+def get_player_timelines(session, user_id):
+    metrics = [metric for metric, title in PLAYER_METRICS]
+    return timelines(player_history(session, user_id, metrics).yield_per(1000), metrics, PLAYER_CHART_POINTS)
+
+
+@blueprint.route('/player/<int:id>', methods=['GET'])
 @requires_auth
+@cached_view(watermark=player_watermark)
 def get_user(id):
     session = Session()
     try:
-        user = session.query(User).filter_by(id=id).first()
-        return render_template('player.html', output=user)
+        user = with_latest_snapshots(session.query(User), User.character).filter_by(id=id).first()
+        if user is None:
+            return flask.Response(status=404)
+        series = get_player_timelines(session, id)
+        charts = [(title, series[metric], chart_points([value for x, value in series[metric]],
+                                                       xs=[x for x, value in series[metric]]))
+                  for metric, title in PLAYER_METRICS]
+        return render_template('player.html', user=user, character=user.character, charts=charts)
     except SQLAlchemyError:
         Session.rollback()
         return flask.Response(status=400)
 
 
-@app.route('/member-equip/<int:squad_id>', methods=['GET'])
+@blueprint.route('/player/<int:id>/history.json', methods=['GET'])
 @requires_auth
+@cached_view(watermark=player_watermark)
+def get_user_history(id):
+    try:
+        series = get_player_timelines(Session(), id)
+        return Response(json.dumps(series, separators=(',', ':')), mimetype='application/json')
+    except SQLAlchemyError:
+        Session.rollback()
+        return flask.Response(status=400)
+
+
+@blueprint.route('/member-equip/<int:squad_id>', methods=['GET'])
+@requires_auth
+@cached_view(scope=admin_scope, watermark=squad_watermark)
 def get_member_equip(squad_id):
-    allowed = False
     try:
         session = Session()
-        id = flask_session['user_id']
-        admins = session.query(Admin).filter(Admin.user_id == id).order_by(Admin.admin_type).all()
-        for adm in admins:
-            where_admin = adm.admin_group
-            admin_type = adm.admin_type
-            if admin_type == 0 or admin_type == 1:
-                allowed = True
-            else:
-                if where_admin == squad_id:
-                    allowed = True
-        if allowed:
+        if PERMISSIONS.can_view_squad(session, flask_session['user_id'], squad_id):
             try:
-                sub_query_1 = session.query(Character.user_id, func.max(Character.date)).group_by(Character.user_id).subquery()
-                sub_query_2 = session.query(Equip.user_id, func.max(Equip.date)).group_by(Equip.user_id).subquery()
-                members = session.query(Character, User, Equip.equip) \
-                    .filter(tuple_(Character.user_id, Character.date).in_(sub_query_1)) \
-                    .join(User, User.id == Character.user_id) \
-                    .outerjoin(Equip, User.id == Equip.user_id) \
-                    .join(SquadMember, SquadMember.user_id == Character.user_id) \
-                    .filter((tuple_(Equip.user_id, Equip.date).in_(sub_query_2)) | (Equip.user_id.is_(None))) \
-                    .filter(SquadMember.squad_id == squad_id) \
-                    .order_by(Character.level.desc())
-                if CASTLE:
-                    members = members.filter(Character.castle == CASTLE)
-                members = members.all()
+                members = squad_members_query(session, squad_id).all()
                 members_new = []
                 total_attack = 0
                 total_defence = 0
                 total_lvl = 0
-                for character, user, equip in members:
-                    member_equip = []
+                for character, user, equip_date, equip in members:
                     total_attack += character.attack
                     total_defence += character.defence
                     total_lvl += character.level
-                    if equip:
-                        equip_lines = equip.split('\n')
-                        for part in EQUIP_PARTS:
-                            flag = False
-                            for item, grade, alias in STUFF[part]:
-                                for line in equip_lines:
-                                    if item in line:
-                                        mod_str = line.split(item)[0]
-                                        if alias:
-                                            member_equip.append([mod_str + alias, COLORS[grade]])
-                                        else:
-                                            member_equip.append([mod_str + item, COLORS[grade]])
-                                        flag = True
-                                        break
-                                if flag:
-                                    break
-                            if not flag:
-                                member_equip.append([' ', None])
-                    else:
-                        member_equip = [[' ', None], [' ', None], [' ', None], [' ', None],
-                                        [' ', None], [' ', None], [' ', None]]
+                    member_equip = get_parsed_equip(user.id, equip_date, equip)
 
-                    if character.date > (datetime.now() - timedelta(days=7)):
+                    if character.date > (datetime.now() - PROFILE_FRESH_PERIOD):
                         fresh = PROFILE_FRESH
                     else:
                         fresh = PROFILE_NOT_FRESH
@@ -221,41 +351,110 @@ def get_member_equip(squad_id):
         return flask.Response(status=400)
 
 
-@app.route('/squads')
+@blueprint.route('/equip-changes/<int:squad_id>', methods=['GET'])
+@requires_auth
+@cached_view(scope=admin_scope, watermark=squad_watermark)
+def get_equip_changes(squad_id):
+    try:
+        session = Session()
+        if not PERMISSIONS.can_view_squad(session, flask_session['user_id'], squad_id):
+            return render_template('forbidden.html')
+        changes = squad_equip_changes(session, squad_id, datetime.now() - EQUIP_CHANGES_PERIOD).all()
+        squad = session.query(Squad).filter(Squad.chat_id == squad_id).first()
+        return render_template('equip_changes.html', changes=changes, squad=squad, parts=EQUIP_PART_TITLES,
+                               upgrades=sum(1 for change, user in changes if change.upgrade))
+    except SQLAlchemyError:
+        Session.rollback()
+        return flask.Response(status=400)
+
+
+@blueprint.route('/squads')
 @requires_auth
+@cached_view(watermark=characters_watermark)
 def squads_function():
     return render_template('squads.html', output=get_squads())
 
 
-@app.route('/top')
+@blueprint.route('/top')
 @requires_auth
 def top():
-    return render_template('top.html', output=MSG_UNDER_CONSTRUCTION)
+    try:
+        session = Session()
+        LEADERBOARDS.refresh(session)
+        squad_id = request.args.get('squad', type=int)
+        tops = [(title, LEADERBOARDS.top(metric, TOP_SIZE, squad_id)) for metric, title in TOP_METRICS]
+        squads = session.query(Squad).order_by(Squad.squad_name).all()
+        return render_template('top.html', tops=tops, squads=squads, squad_id=squad_id, battle=LEADERBOARDS.battle)
+    except SQLAlchemyError:
+        Session.rollback()
+        return flask.Response(status=400)
 
 
-@app.route('/build')
+@blueprint.route('/build')
 @requires_auth
 def build():
-    return render_template('build.html', output=MSG_UNDER_CONSTRUCTION)
+    try:
+        session = Session()
+        buildings = build_progress(session).all()
+        building = request.args.get('building') or (buildings[0].building if buildings else None)
+        hourly = build_series(session, building, 1, BUILD_HOURS_SHOWN) if building else []
+        daily = build_series(session, building, 24, BUILD_DAYS_SHOWN) if building else []
+        contributors = build_contributors(session, building, TOP_SIZE).all() if building else []
+        squads = build_squad_contributions(session, building).all() if building else []
+        return render_template('build.html', buildings=buildings, building=building, hourly=hourly, daily=daily,
+                               hourly_chart=chart_points([bucket.progress for bucket in hourly]),
+                               daily_chart=chart_points([bucket.progress for bucket in daily]),
+                               contributors=contributors, squads=squads)
+    except SQLAlchemyError:
+        Session.rollback()
+        return flask.Response(status=400)
 
 
-@app.route('/reports')
+@blueprint.route('/reports')
 @requires_auth
 def reports():
-    return render_template('reports.html', output=MSG_UNDER_CONSTRUCTION)
+    try:
+        session = Session()
+        squad_id = request.args.get('squad', 0, type=int)
+        user_id = request.args.get('user', type=int)
+        battles = battle_rollups(session, squad_id, REPORTS_BATTLES).all()
+        members = squad_size(session, squad_id) if squad_id else users_count(session)
+        trend = player_reports(session, user_id, REPORTS_BATTLES).all() if user_id else []
+        squads = session.query(Squad).order_by(Squad.squad_name).all()
+        return render_template('reports.html', battles=battles, members=members, trend=trend, squads=squads,
+                               squad_id=squad_id, user_id=user_id)
+    except SQLAlchemyError:
+        Session.rollback()
+        return flask.Response(status=400)
 
 
-@app.route('/squad_craft')
+@blueprint.route('/squad_craft')
 @requires_auth
+@cached_view(scope=admin_scope, watermark=stock_watermark)
 def squad_craft():
-    return render_template('squad_craft.html', output=MSG_UNDER_CONSTRUCTION)
+    try:
+        session = Session()
+        user_id = flask_session['user_id']
+        squads = [squad for squad in session.query(Squad).order_by(Squad.squad_name)
+                  if PERMISSIONS.can_view_squad(session, user_id, squad.chat_id)]
+        squad_id = request.args.get('squad', type=int)
+        if squad_id is None:
+            squad_id = squads[0].chat_id if squads else None
+        elif not PERMISSIONS.can_view_squad(session, user_id, squad_id):
+            return render_template('forbidden.html')
+        stock = squad_stock(squad_stock_query(session, squad_id)) if squad_id is not None else None
+        return render_template('squad_craft.html', squads=squads, squad_id=squad_id,
+                               resources=stock.resources() if stock else [])
+    except SQLAlchemyError:
+        Session.rollback()
+        return flask.Response(status=400)
 
 
-@app.route('/birja')
+@blueprint.route('/birja')
 def birja():
-    return render_template('birja.html')
+    return STATIC_PAGES['birja.html'].response()
 
 
-@app.route('/wrap')
+@blueprint.route('/wrap')
 def wrap():
-    return render_template('wrap.html')
+    return STATIC_PAGES['wrap.html'].response()
@@ -3,3 +3,46 @@ AUTH_PASS = None  # specify your pass to enable basic authorisation
 DB = 'mysql+pymysql://<username>:<password>@<host>/<dbname>?charset=utf8mb4'  # Строчка подключения к базе данных MySQL
 CASTLE = None # Флаг замка, который вы хотите обслуживать (например '🇮🇲'), оставьте None, чтобы не было ограничений
 APP_SECRET_KEY = 'secret'  # Ключ для сессии. Обязательно поменяйте
+EQUIP_CACHE_SIZE = 5000  # Сколько разобранных строк экипировки держать в памяти
+LATEST_SNAPSHOTS = False  # Вести и читать characters_latest/equip_latest; после включения и перезапуска бота выполните `flask rebuild-latest`
+RESPONSE_CACHE_TTL = 60  # Сколько секунд хранить отрисованные страницы /users, /squads, /member-equip
+RESPONSE_CACHE_BACKEND = None  # None - кэш в памяти процесса; для нескольких воркеров, например, werkzeug RedisCache
+STATIC_PAGES_MAX_AGE = 86400  # Сколько секунд браузеры могут не перезапрашивать /birja и /wrap
+USERS_PAGE_SIZE = 100  # Игроков на одной странице /users
+SLOW_REQUEST_MS = None  # Запросы дольше стольки миллисекунд пишутся в лог вместе с их SQL, None - выключено
+DEBUG_LAZY_LOADS = False  # Писать в лог ленивые загрузки связей ORM с местом в шаблоне, где они произошли
+QUERY_BUDGETS = {}  # Допустимое число SQL-запросов на view, например {'views.get_member_equip': 5}
+PERMISSIONS_TTL = 60  # Сколько секунд помнить права админов без повторного запроса в базу
+BANS_REFRESH_INTERVAL = 60  # Как часто (в секундах) подгружать новые баны из базы
+LOG_BUFFERED = False  # Писать таблицу log пачками из фонового потока вместо коммита на каждое действие
+LOG_BATCH_SIZE = 100  # Сколько строк лога писать одним запросом
+LOG_FLUSH_INTERVAL = 1.0  # Не дольше скольких секунд держать строки лога в памяти
+LOG_MAX_QUEUE = 10000  # Сколько строк лога может ждать записи
+LOG_OVERFLOW_POLICY = 'drop'  # Что делать при полной очереди лога: 'drop' - отбросить строку, 'block' - ждать места
+BATTLE_HOURS = [1, 9, 17]  # Часы битв во времени, в котором бот записывает даты
+TOP_SIZE = 10  # Сколько игроков показывать в каждом топе
+TOP_REFRESH_INTERVAL = 10  # Как часто (в секундах) подтягивать в топы новые профили и репорты
+REPORTS_BATTLES = 20  # Сколько последних битв показывать на странице репортов
+BUILD_HOURS_SHOWN = 48  # Сколько последних часов прогресса стройки показывать на графике
+BUILD_DAYS_SHOWN = 30  # Сколько последних дней прогресса стройки показывать на графике
+STOCK_CACHE_SIZE = 5000  # Сколько разобранных стоков держать в памяти
+PLAYER_CHART_POINTS = 200  # До скольких точек прореживать графики на странице игрока
+# Правила `flask compact-history` по таблицам: [(возраст, период)], строки младше возраста
+# прореживаются до одной за период (None - хранить все), старше последнего правила - в архив
+# RETENTION = {'characters': [(timedelta(days=30), None), (timedelta(days=365), timedelta(days=1)),
+#                             (None, timedelta(weeks=1))]}
+RETENTION_ARCHIVE_DIR = 'archive'  # Куда складывать архивы удалённых строк
+RETENTION_BATCH = 1000  # Сколько строк удалять за одну транзакцию
+CREATE_SCHEMA = False  # Создавать недостающие таблицы при старте приложения, иначе `flask create-schema`
+DB_POOL_SIZE = 200  # Соединений в пуле на процесс
+DB_MAX_OVERFLOW = 50  # Сколько соединений можно открыть сверх пула
+DB_POOL_RECYCLE = 3600  # Через сколько секунд переоткрывать соединение (меньше wait_timeout MySQL)
+DB_PRE_PING = True  # Проверять соединение перед выдачей из пула
+DB_REPLICAS = []  # Реплики для чтения страниц сайта, например ['mysql+pymysql://<username>:<password>@<replica>/<dbname>?charset=utf8mb4']
+REPLICA_MAX_LAG = 30  # На сколько секунд реплика может отставать, прежде чем страницы перейдут на основную базу
+REPLICA_CHECK_INTERVAL = 5  # Как часто (в секундах) проверять отставание реплик
+REPLICA_CONNECT_TIMEOUT = 2  # Сколько секунд ждать соединения с репликой, прежде чем пропустить её
+DB_CONNECTION_BUDGET = 100  # Сколько соединений с базой всего может открыть wsgi.py на все воркеры
+WEB_BIND = '0.0.0.0:5000'  # Адрес gunicorn
+WEB_WORKERS = 4  # Процессов gunicorn
+WEB_THREADS = 8  # Потоков в каждом процессе
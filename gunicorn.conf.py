@@ -0,0 +1,14 @@
+# gunicorn -c gunicorn.conf.py wsgi:app
+# Процессы и потоки задаются в config.py (WEB_WORKERS, WEB_THREADS) или ключами --workers/--threads
+from app.serving import WEB_BIND, WEB_WORKERS, WEB_THREADS, pool_options
+
+bind = WEB_BIND
+workers = WEB_WORKERS
+threads = WEB_THREADS
+worker_class = 'gthread'
+
+
+def post_fork(server, worker):
+    # Пул каждого процесса - его доля DB_CONNECTION_BUDGET при фактическом числе процессов и потоков
+    from app.types import init_engine
+    init_engine(**pool_options(workers=server.cfg.workers, threads=server.cfg.threads))
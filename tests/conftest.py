@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+import types
+from base64 import b64encode
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_config():
+    """config_sample.py with a throwaway SQLite database instead of MySQL."""
+    config = types.ModuleType('config')
+    with open(os.path.join(ROOT, 'config_sample.py'), encoding='utf-8') as sample:
+        exec(sample.read(), config.__dict__)
+    config.DB = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+    config.AUTH_LOGIN, config.AUTH_PASS = 'admin', 'secret'
+    return config
+
+
+sys.modules['config'] = load_config()
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import create_app
+    return create_app(create_schema=True)
+
+
+@pytest.fixture
+def session(app):
+    from app.types import Base, Session, PERMISSIONS
+    from app.views import RESPONSE_CACHE
+    yield Session()
+    Session.remove()
+    with app.app_context():
+        engine = Session().get_bind()
+        with engine.begin() as connection:
+            for table in reversed(Base.metadata.sorted_tables):
+                connection.execute(table.delete())
+        Session.remove()
+    PERMISSIONS.invalidate()
+    RESPONSE_CACHE.backend.clear()
+
+
+@pytest.fixture
+def client(app):
+    def login(user_id):
+        client = app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['user_id'] = user_id
+        return client
+    return login
+
+
+@pytest.fixture
+def auth_headers():
+    return {'Authorization': 'Basic ' + b64encode(b'admin:secret').decode('ascii')}
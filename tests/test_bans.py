@@ -0,0 +1,58 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app.types import BanRegistry, Ban, Session, User, get_engine
+
+
+def add_users(session, *user_ids):
+    for user_id in user_ids:
+        session.add(User(id=user_id, username='player{}'.format(user_id)))
+    session.flush()
+
+
+def test_bans(session):
+    now = datetime.now()
+    add_users(session, 1, 2, 3, 4)
+    session.add(Ban(user_id=1, from_date=now, to_date=now + timedelta(days=1)))
+    session.add(Ban(user_id=2, from_date=now - timedelta(days=3), to_date=now - timedelta(days=1)))
+    session.add(Ban(user_id=3, from_date=now, to_date=None))
+    session.commit()
+    bans = BanRegistry(refresh_interval=60)
+    assert [bans.is_banned(session, user_id) for user_id in (1, 2, 3, 4)] == [True, False, True, False]
+
+
+def test_concurrent_refresh_runs_once(session):
+    add_users(session, 1)
+    session.add(Ban(user_id=1, from_date=datetime.now(), to_date=None))
+    session.commit()
+    bans = BanRegistry(refresh_interval=0.2)
+    assert bans.is_banned(session, 1)
+    time.sleep(0.3)
+    ban_queries = []
+
+    def count_bans(connection, cursor, statement, *args):
+        if 'FROM banned_users' in statement:
+            ban_queries.append(statement)
+
+    start = threading.Barrier(8)
+    results = []
+
+    def check():
+        start.wait()
+        results.append(bans.is_banned(Session(), 1))
+        Session.remove()
+
+    event.listen(get_engine(), 'before_cursor_execute', count_bans)
+    try:
+        threads = [threading.Thread(target=check) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        event.remove(get_engine(), 'before_cursor_execute', count_bans)
+    assert len(ban_queries) == 1
+    assert results == [True] * 8
@@ -0,0 +1,16 @@
+from app.cache import ParseCache
+
+
+def test_parse_cache_parses_every_row_once():
+    parsed = []
+
+    def parse(text):
+        parsed.append(text)
+        return text.upper()
+
+    cache = ParseCache(parse, maxsize=10)
+    assert [cache.parse(1, 'a'), cache.parse(1, 'a'), cache.parse(2, 'b')] == ['A', 'A', 'B']
+    assert parsed == ['a', 'b']
+    # Строки без ключа не кэшируются
+    assert [cache.parse(None, 'c'), cache.parse(None, 'c')] == ['C', 'C']
+    assert (cache.hits, cache.misses, len(cache)) == (1, 2, 2)
@@ -0,0 +1,73 @@
+import random
+
+import pytest
+
+from app.constants import STUFF, EQUIP_PARTS, COLORS
+from app.equip import EquipMatcher, EQUIP_MATCHER
+
+FIXTURE = '''🎽Экипировка +35⚔️+30🛡
+⚡+1 Меч берсеркера +10⚔️
+Кинжал охотника +5⚔️ +5🛡
+Шлем паладина +8🛡
+Браслеты охотника +3⚔️
+⚡+2 Броня паладина +15🛡
+Ботинки демона +5🛡
+Бутылка рома
+Кроличья лапка'''
+
+# Названия, которые пересекаются и входят друг в друга
+OVERLAPPING_STUFF = {'pri': [('Меч тьмы', 'grade3', None), ('Меч', 'grade1', 'Простой меч'), ('ч т', 'grade2', None)],
+                     'sec': [('тьмыщит', 'grade2', None), ('щит', 'grade1', None)]}
+OVERLAPPING_PARTS = ['pri', 'sec']
+
+
+def legacy_match(text, stuff=STUFF, parts=EQUIP_PARTS, colors=COLORS):
+    """The nested loop get_member_equip used before EquipMatcher, kept as the reference."""
+    member_equip = []
+    if text:
+        equip_lines = text.split('\n')
+        for part in parts:
+            flag = False
+            for item, grade, alias in stuff[part]:
+                for line in equip_lines:
+                    if item in line:
+                        mod_str = line.split(item)[0]
+                        if alias:
+                            member_equip.append([mod_str + alias, colors[grade]])
+                        else:
+                            member_equip.append([mod_str + item, colors[grade]])
+                        flag = True
+                        break
+                if flag:
+                    break
+            if not flag:
+                member_equip.append([' ', None])
+    else:
+        member_equip = [[' ', None]] * len(parts)
+    return member_equip
+
+
+def random_texts(items, count, seed):
+    rng = random.Random(seed)
+    fragments = items + ['⚡+1 ', '+5⚔️', ' ', '\n', 'Щит', 'Кинж', 'рома', 'x', '\r\n']
+    for _ in range(count):
+        yield ''.join(rng.choice(fragments) for _ in range(rng.randint(0, 15)))
+
+
+@pytest.mark.parametrize('text', [None, '', 'Ничего', FIXTURE, FIXTURE.replace('\n', ' ')])
+def test_match_fixture(text):
+    assert EQUIP_MATCHER.match(text) == legacy_match(text)
+
+
+def test_match_random_texts():
+    items = [item for part in EQUIP_PARTS for item, grade, alias in STUFF[part]]
+    for text in random_texts(items, 5000, seed=1):
+        assert EQUIP_MATCHER.match(text) == legacy_match(text), text
+
+
+def test_match_overlapping_names():
+    matcher = EquipMatcher(OVERLAPPING_STUFF, OVERLAPPING_PARTS)
+    items = [item for part in OVERLAPPING_PARTS for item, grade, alias in OVERLAPPING_STUFF[part]]
+    texts = ['⚡+1 Меч тьмыщит', 'Меч\nтьмыщит', 'ч т', 'щит Меч тьмы'] + list(random_texts(items, 2000, seed=2))
+    for text in texts:
+        assert matcher.match(text) == legacy_match(text, OVERLAPPING_STUFF, OVERLAPPING_PARTS), text
@@ -0,0 +1,12 @@
+from app.explain import check_queries
+
+# Запросы, которые без LATEST_SNAPSHOTS группируют всю историю
+GROUPED_HISTORY = {'squads', 'users', 'users-page', 'users-count', 'member-equip'}
+
+
+def test_every_view_query_is_checked(session):
+    checked = {name: scans for name, plan, scans in check_queries(session)}
+    assert {'squad-stock', 'equip-changes', 'snapshot-watermark', 'battle-rollups', 'squad-size', 'player-reports',
+            'player-history', 'build-progress', 'build-series', 'build-contributors',
+            'build-squad-contributions'} <= set(checked)
+    assert not {name: scans for name, scans in checked.items() if scans and name not in GROUPED_HISTORY}
@@ -0,0 +1,63 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app.leaderboards import Leaderboards
+from app.types import Session, User, Character, Report, get_engine
+
+
+def add_player(session, user_id, level, date):
+    session.add(User(id=user_id, username='player{}'.format(user_id)))
+    session.add(Character(user_id=user_id, date=date, name='Player{}'.format(user_id), prof='p', level=level,
+                          attack=1, defence=1, exp=level * 100, needExp=1, castle='c', gold=0, donateGold=0))
+
+
+def test_refresh_adds_new_profiles_and_reports(session):
+    now = datetime.now().replace(microsecond=0)
+    add_player(session, 1, 10, now - timedelta(hours=1))
+    add_player(session, 2, 20, now - timedelta(hours=1))
+    session.commit()
+    leaderboards = Leaderboards(refresh_interval=0)
+    leaderboards.refresh(session)
+    assert [user_id for user_id, name, value in leaderboards.top('level')] == [2, 1]
+    session.add(Character(user_id=1, date=now, name='Player1', prof='p', level=30, attack=1, defence=1, exp=1,
+                          needExp=1, castle='c', gold=0, donateGold=0))
+    session.add(Report(user_id=1, date=now, name='Player1', castle='c', earned_exp=7, earned_gold=1))
+    session.commit()
+    leaderboards.refresh(session)
+    assert leaderboards.top('level') == [(1, 'Player1', 30), (2, 'Player2', 20)]
+    assert leaderboards.top('earned_exp') == [(1, 'Player1', 7)]
+
+
+def test_concurrent_refresh_runs_once(session):
+    add_player(session, 1, 10, datetime.now())
+    session.commit()
+    leaderboards = Leaderboards(refresh_interval=0.2)
+    leaderboards.refresh(session)
+    time.sleep(0.3)
+    report_queries = []
+
+    def count_reports(connection, cursor, statement, *args):
+        if 'FROM reports' in statement:
+            report_queries.append(statement)
+
+    start = threading.Barrier(8)
+
+    def refresh():
+        start.wait()
+        leaderboards.refresh(Session())
+        Session.remove()
+
+    event.listen(get_engine(), 'before_cursor_execute', count_reports)
+    try:
+        threads = [threading.Thread(target=refresh) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        event.remove(get_engine(), 'before_cursor_execute', count_reports)
+    assert len(report_queries) == 1
+    assert leaderboards.top('level') == [(1, 'Player1', 10)]
@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from sqlalchemy import func
+
+from app.types import Log, LogSink, get_engine
+
+EXIT_SCRIPT = '''
+import sys
+import time
+sys.path.insert(0, {tests!r})
+import conftest
+sys.modules['config'].DB = {db!r}
+from app.types import LogSink
+sink = LogSink(flush_interval=10)
+for number in range(5):
+    sink.put({{'id': number + 1, 'date': None, 'user_id': number, 'chat_id': 0, 'func_name': 'test', 'args': ''}})
+while not sink.queue.empty():
+    time.sleep(0.01)
+'''
+
+
+def log_row(number):
+    return {'id': number + 1, 'date': None, 'user_id': number, 'chat_id': 0, 'func_name': 'test', 'args': ''}
+
+
+def log_count(session):
+    return session.query(func.count(Log.id)).scalar()
+
+
+def test_stop_writes_rows_taken_by_thread(session):
+    sink = LogSink(get_engine(), flush_interval=10)
+    for number in range(5):
+        sink.put(log_row(number))
+    # Поток забрал строки и ждёт следующих до конца интервала
+    while not sink.queue.empty():
+        time.sleep(0.01)
+    started = time.time()
+    sink.stop()
+    assert time.time() - started < 5
+    assert log_count(session) == 5
+    assert sink.written == 5
+
+
+def test_rows_are_written_on_interpreter_exit(session):
+    script = EXIT_SCRIPT.format(tests=os.path.dirname(os.path.abspath(__file__)), db=sys.modules['config'].DB)
+    subprocess.check_call([sys.executable, '-c', script])
+    assert log_count(session) == 5
+
+
+def test_drop_policy_counts_dropped_rows(session):
+    sink = LogSink(get_engine(), batch_size=1, max_queue=2, policy='drop')
+    # Пока другая транзакция пишет в базу, поток лога ждёт с первой строкой в руках
+    with get_engine().begin() as connection:
+        connection.execute(Log.__table__.insert().values(log_row(100)))
+        sink.put(log_row(0))
+        while not sink.queue.empty():
+            time.sleep(0.01)
+        for number in range(1, 5):
+            sink.put(log_row(number))
+    sink.stop()
+    assert sink.dropped == 2
+    assert sink.written == 3
+    assert log_count(session) == 4
+
+
+def test_one_writer_thread_for_concurrent_puts(session):
+    sink = LogSink(get_engine(), batch_size=10, flush_interval=0.05)
+    start = threading.Barrier(8)
+
+    def put_rows(first):
+        start.wait()
+        for number in range(first, first + 50):
+            sink.put(log_row(number))
+
+    threads = [threading.Thread(target=put_rows, args=(first,)) for first in range(0, 400, 50)]
+    # Частое переключение потоков, чтобы гонка при первом put() проявлялась
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    writers = [thread for thread in threading.enumerate() if thread.name == 'log-sink']
+    sink.stop()
+    assert len(writers) == 1
+    assert sink.written == 400
+    assert log_count(session) == 400
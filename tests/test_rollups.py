@@ -0,0 +1,105 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.sql.dml import Update
+from sqlalchemy.sql.expression import Select
+
+from app import types
+from app.rollups import rebuild_latest_snapshots
+from app.types import (BattleRollup, BuildBucket, Character, CharacterLatest, Equip, EquipLatest, User, Report,
+                       add_to_rollup, update_latest, get_engine)
+
+
+class RacingConnection(object):
+    """Connection on which another writer inserts `row` right after the first statement of
+    `statement_type` has missed it.
+    """
+
+    def __init__(self, connection, table, row, statement_type=Update):
+        self.connection = connection
+        self.table = table
+        self.row = row
+        self.statement_type = statement_type
+        self.raced = False
+
+    def execute(self, statement, *args, **kwargs):
+        result = self.connection.execute(statement, *args, **kwargs)
+        if not self.raced and isinstance(statement, self.statement_type):
+            self.raced = True
+            # SQLite не пустит второго писателя, поэтому строка вставляется в той же транзакции
+            self.connection.execute(self.table.insert().values(self.row))
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def test_battle_rollup_row_created_concurrently(session):
+    battle = datetime(2018, 1, 1, 9)
+    key = {'battle': battle, 'squad_id': 0}
+    table = BattleRollup.__table__
+    other = dict(key, participants=1, earned_exp=10, earned_gold=1, earned_stock=0)
+    with get_engine().begin() as connection:
+        connection.execute(User.__table__.insert().values(id=1, username='player'))
+        add_to_rollup(RacingConnection(connection, table, other), BattleRollup, key,
+                      {'participants': 1, 'earned_exp': 5, 'earned_gold': 2, 'earned_stock': 3})
+    row = session.query(BattleRollup).one()
+    assert (row.participants, row.earned_exp, row.earned_gold, row.earned_stock) == (2, 15, 3, 3)
+    # Откатывается только вставка в savepoint, а не вся транзакция
+    assert session.query(User).count() == 1
+
+
+def test_reports_are_rolled_up(session):
+    session.add(User(id=1, username='player'))
+    session.flush()
+    for minute in [5, 10]:
+        session.add(Report(user_id=1, date=datetime(2018, 1, 1, 9, minute), name='Player', castle='c',
+                           earned_exp=10, earned_gold=1, earned_stock=2))
+        session.commit()
+    row = session.query(BattleRollup).one()
+    assert (row.squad_id, row.participants, row.earned_exp) == (0, 1, 10)
+
+
+def test_build_bucket_row_created_concurrently(session):
+    start = datetime(2018, 1, 1, 9)
+    key = {'building': 'Стена', 'hours': 1, 'start': start}
+    other = dict(key, reports=1, progress=40, last_date=datetime(2018, 1, 1, 9, 10))
+    with get_engine().begin() as connection:
+        add_to_rollup(RacingConnection(connection, BuildBucket.__table__, other), BuildBucket, key, {'reports': 1},
+                      latest={'progress': 45}, date=datetime(2018, 1, 1, 9, 20))
+    row = session.query(BuildBucket).one()
+    assert (row.reports, row.progress, row.last_date) == (2, 45, datetime(2018, 1, 1, 9, 20))
+
+
+def character(date, level):
+    return {'user_id': 1, 'date': date, 'name': 'Player', 'prof': 'p', 'level': level, 'attack': 1, 'defence': 1,
+            'exp': 1, 'needExp': 2, 'castle': 'c', 'gold': 0, 'donateGold': 0}
+
+
+def test_latest_snapshot_created_concurrently(session):
+    session.add(User(id=1, username='player'))
+    session.commit()
+    table = CharacterLatest.__table__
+    for other_date, expected_level in [(datetime(2018, 1, 1, 9), 11), (datetime(2018, 1, 1, 11), 10)]:
+        session.query(CharacterLatest).delete()
+        session.commit()
+        target = Character(**character(datetime(2018, 1, 1, 10), 11))
+        with get_engine().begin() as connection:
+            # Вставка параллельного снимка проходит между SELECT и INSERT
+            update_latest(RacingConnection(connection, table, character(other_date, 10), Select),
+                          CharacterLatest, target)
+        session.expire_all()
+        assert session.query(CharacterLatest.level).scalar() == expected_level
+
+
+@pytest.mark.parametrize('latest', [False, True])
+def test_latest_tables_kept_only_when_enabled(session, monkeypatch, latest):
+    monkeypatch.setattr(types, 'LATEST_SNAPSHOTS', latest)
+    session.add(User(id=1, username='player'))
+    session.flush()
+    session.add(Character(**character(datetime(2018, 1, 1, 10), 11)))
+    session.add(Equip(user_id=1, date=datetime(2018, 1, 1, 10), equip='Меч'))
+    session.commit()
+    assert session.query(CharacterLatest).count() == session.query(EquipLatest).count() == int(latest)
+    # Включённые таблицы заполняет rebuild-latest
+    assert dict(rebuild_latest_snapshots(session)) == {'characters_latest': 1, 'equip_latest': 1}
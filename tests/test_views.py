@@ -0,0 +1,96 @@
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import queries, views
+from app.lazyloads import query_budget
+from app.types import AdminType, Admin, Group, Squad, SquadMember, User, Character, Equip, Stock
+from app.views import RESPONSE_CACHE
+
+
+def add_squad_stock(session):
+    session.add(Group(id=-100, title='Squad', bot_in_group=True))
+    session.add(Squad(chat_id=-100, squad_name='Squad'))
+    session.add(User(id=1, username='admin', first_name='Admin'))
+    session.add(User(id=2, username='player', first_name='Player'))
+    session.flush()
+    session.add(Admin(user_id=1, admin_type=AdminType.SUPER.value, admin_group=0))
+    session.add(SquadMember(squad_id=-100, user_id=2, approved=True))
+    now = datetime.now()
+    session.add(Stock(user_id=2, date=now - timedelta(days=1), stock='Нитки (1)', stock_type=0))
+    session.add(Stock(user_id=2, date=now, stock='Нитки (12)\nКожа (3)', stock_type=0))
+    session.commit()
+
+
+@pytest.mark.parametrize('latest', [False, True])
+def test_squad_craft(session, client, monkeypatch, latest):
+    monkeypatch.setattr(queries, 'LATEST_SNAPSHOTS', latest)
+    add_squad_stock(session)
+    RESPONSE_CACHE.backend.clear()
+    response = client(1).get('/squad_craft?squad=-100')
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert 'Нитки' in page and '12' in page
+    assert 'Кожа' in page
+
+
+
+def add_members(session, user_ids):
+    now = datetime.now()
+    for user_id in user_ids:
+        session.add(User(id=user_id, username='player{}'.format(user_id), first_name='Player'))
+        session.flush()
+        session.add(SquadMember(squad_id=-100, user_id=user_id, approved=True))
+        for days in [3, 0]:
+            session.add(Character(user_id=user_id, date=now - timedelta(days=days), name='Player{}'.format(user_id),
+                                  prof='p', level=10 + user_id - days, attack=user_id, defence=1, exp=1, needExp=2,
+                                  castle='c', gold=0, donateGold=0))
+            session.add(Equip(user_id=user_id, date=now - timedelta(days=days), equip='⚡+1 Меч берсеркера'))
+    session.commit()
+
+
+@pytest.mark.parametrize('path', ['/member-equip/-100', '/users', '/users?all=1', '/squads'])
+def test_no_queries_per_member(session, client, auth_headers, path):
+    """Pages listing members load their snapshots together: no lazy loads and as many queries
+    for twelve members as for two.
+    """
+    session.add(Group(id=-100, title='Squad', bot_in_group=True))
+    session.add(Squad(chat_id=-100, squad_name='Squad'))
+    session.add(User(id=1, username='admin', first_name='Admin'))
+    session.flush()
+    session.add(Admin(user_id=1, admin_type=AdminType.SUPER.value, admin_group=0))
+    add_members(session, range(2, 4))
+    admin = client(1)
+    with query_budget(max_lazy_loads=0) as two_members:
+        RESPONSE_CACHE.backend.clear()
+        response = admin.get(path, headers=auth_headers)
+        # /users отдаётся потоком, запросы идут при чтении тела
+        response.get_data()
+        assert response.status_code == 200
+    add_members(session, range(4, 14))
+    with query_budget(max_queries=two_members.queries, max_lazy_loads=0):
+        RESPONSE_CACHE.backend.clear()
+        response = admin.get(path, headers=auth_headers)
+        response.get_data()
+        assert response.status_code == 200
+
+
+def test_users_pages_keep_players_without_level(session, client, auth_headers, monkeypatch):
+    monkeypatch.setattr(views, 'USERS_PAGE_SIZE', 1)
+    now = datetime.now()
+    for user_id, level in [(1, 5), (2, None), (3, None), (4, 0)]:
+        session.add(User(id=user_id, username='player{}'.format(user_id), first_name='Player'))
+        session.add(Character(user_id=user_id, date=now, name='Player{}'.format(user_id), prof='p', level=level,
+                              attack=1, defence=1, exp=1, needExp=2, castle='c', gold=0, donateGold=0))
+    session.commit()
+    player = client(1)
+    names, path = [], '/users'
+    while path:
+        response = player.get(path, headers=auth_headers)
+        assert response.status_code == 200
+        page = response.get_data(as_text=True)
+        names += re.findall(r'Player\d', page)
+        after = re.search(r'/users\?after=([-\d]+_\d+)', page)
+        path = '/users?after=' + after.group(1) if after else None
+    assert names == ['Player1', 'Player4', 'Player3', 'Player2']